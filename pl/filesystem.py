@@ -108,6 +108,13 @@ Also '-' will remove the file(s) from the directory object
 Also, the above operation can be replaced by just using obj.add(other) or 
 obj.sub(other), they are same.
 
+Directory listings are cached for a short time and shared by all directory
+objects in the process (see ListingCache), so creating directory objects for
+the same path frequently is cheap. It can be tuned or cleared by doing:
+
+>>> listing_cache.ttl = 5
+>>> listing_cache.clear()
+
 Please read/check API doc see the usage of other functions.
 """
 import os
@@ -116,6 +123,9 @@ import shutil
 import stat
 import platform
 import hashlib
+import threading
+import time
+import collections
 
 __author__ = "ihybrd@gmail.com"
 
@@ -128,6 +138,84 @@ class TypeFile:
 class TypeDirectory: 
     """filesystem directory type defination."""
 
+class ListingCache(object):
+    """ListingCache keeps the result of os.listdir() for recently listed
+    directories, so creating directory objects for the same path again and
+    again (directory.parent, sub directories from the iterator, etc.) doesn't
+    hit the disk every time. There is one shared instance in this module,
+    `listing_cache`, which is used by all the directory objects.
+
+    A cached listing is only reused if it's younger than `ttl` seconds and the
+    mtime of the directory hasn't been changed. The cache holds at most
+    `max_size` paths, the least recently used path is dropped first.
+
+    >>> listing_cache.ttl = 10 # keep listings for 10 seconds
+    >>> listing_cache.max_size = 4096
+    >>> listing_cache.clear()
+    """
+    def __init__(self, ttl = 2.0, max_size = 1024):
+        """Constructor.
+
+        Args:
+            ttl: the max age of a cached listing in seconds, 0 disables cache.
+            max_size: the max number of the cached directories.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict() # path: (mtime, time, list)
+        self._lock = threading.Lock()
+
+    def listdir(self, path, refresh = False):
+        """Returns the content of the path like os.listdir() does.
+
+        Args:
+            path: the absolute path of a directory.
+            refresh: True to ignore the cached listing and list it again.
+        Returns:
+            a new list of names, it's safe to modify it.
+        """
+        mtime = os.stat(path).st_mtime
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if (entry and not refresh and entry[0] == mtime and 
+                    now - entry[1] < self.ttl):
+                self._entries[path] = entry # move to the end (newest)
+                return list(entry[2])
+        content = os.listdir(path)
+        if self.ttl <= 0 or self.max_size <= 0:
+            return content
+        with self._lock:
+            self._entries[path] = (mtime, now, tuple(content))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+        return content
+
+    def invalidate(self, path, recursive = False):
+        """Drops the cached listing of the path.
+
+        Args:
+            path: the directory path.
+            recursive: True to drop all the cached paths under it as well.
+        """
+        path = os.path.abspath(path)
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._lock:
+            self._entries.pop(path, None)
+            if recursive:
+                for key in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[key]
+
+    def clear(self):
+        """Drops all the cached listings."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+listing_cache = ListingCache()
+
 class _BaseFileSystem(object):
     """_BaseFileSytem class defines the most basic filesystem object, which 
     contains methods and properties that can be shared by file or directory. 
@@ -145,14 +233,42 @@ class _BaseFileSystem(object):
         Args:
             in_path: file path or dir path
         """
+        self._path = in_path
+        self._load()
+
+    def _load(self):
+        """Validates self._path and loads the info of the path from disk."""
         # get platform name
         self._platform = platform.system().lower()
         # validate path, get is_unc, type
-        self._path, self._is_unc, self._type = self._validate(in_path,
+        self._path, self._is_unc, self._type = self._validate(self._path,
                 self._platform)
         # normalize path, remove the seperater in the end
         self._size = os.path.getsize(self._path)
 
+    # attributes which are not carried by the pickle, see __reduce__()
+    _lazy_attrs = ('_platform', '_is_unc', '_size')
+
+    def __getattr__(self, name):
+        """Only called when the attribute can't be found. Objects coming from
+        a pickle only have the path, so the rest attributes are loaded (and
+        the path is validated again) at the first time they are needed.
+        """
+        if name not in self._lazy_attrs or '_path' not in self.__dict__:
+            raise AttributeError(name)
+        self._load()
+        return self.__dict__[name]
+
+    def __reduce__(self):
+        """Pickles the object in a compact form: (class, path, size). 
+        
+        Nothing is read from the disk when unpickling, the object would be 
+        revalidated in the receiving process when it's used. Size is only 
+        carried if it's been loaded.
+        """
+        return (_restore, (self.__class__, self._path, 
+                self.__dict__.get('_size')))
+
     def __eq__(self, other):
         """ x == y calls this method.
         
@@ -327,6 +443,8 @@ class _BaseFileSystem(object):
             raise FSError("file exists cannot use same name.")
         new_name = os.path.join(os.path.dirname(self._path), new_name)
         os.rename(self._path, new_name)
+        listing_cache.invalidate(self._path, recursive = True)
+        listing_cache.invalidate(self.dir)
         self._path = new_name
 
 
@@ -338,9 +456,11 @@ class phile(_BaseFileSystem):
     This class defines the base file object, can be inherited and expanded by 
     other file based classes as well.
     """
+    __size_md5 = 4096
+    _fs_type = TypeFile
+
     def __init__(self, in_path = None):
         super(phile, self).__init__(in_path)
-        self.__size_md5 = 4096
 
     def is_lnk(self):
         """Chechs if the current file is a .lnk file"""
@@ -402,6 +522,8 @@ class directory(_BaseFileSystem):
     other directory based classes as well.
     """
     _walk_err_collection = []
+    _fs_type = TypeDirectory
+    _lazy_attrs = _BaseFileSystem._lazy_attrs + ('_content',)
     
     def __init__(self, in_path, do_walk = False):
         """Initializes the directory object.
@@ -412,8 +534,19 @@ class directory(_BaseFileSystem):
                 tree, otherwise just iterates the current dir.
         """
         super(directory, self).__init__(in_path)
-        self._content = os.listdir(self._path + os.sep)
         self._do_walk = do_walk
+
+    def _load(self):
+        """Validates the path and lists the content of the directory."""
+        super(directory, self)._load()
+        self._content = listing_cache.listdir(self._path)
+
+    def __reduce__(self):
+        """Pickles the directory as (class, path, size, do_walk), the content
+        isn't carried, it'll be listed again in the receiving process.
+        """
+        func, args = super(directory, self).__reduce__()
+        return (func, args + (self._do_walk,))
     
     def __iter__(self):
         """Yields the information from the current directory.
@@ -579,7 +712,7 @@ class directory(_BaseFileSystem):
             
     def _update(self):
         """Refreshes the content info from the directory"""
-        self._content = os.listdir(self._path)
+        self._content = listing_cache.listdir(self._path, refresh = True)
         
     def _parent(self):
         return self._path + os.sep + os.pardir # return parent dir in string
@@ -699,6 +832,8 @@ class directory(_BaseFileSystem):
     def delete(self):
         """delele current dir (not finished) """
         shutil.rmtree(self._path)
+        listing_cache.invalidate(self._path, recursive = True)
+        listing_cache.invalidate(self.dir)
 
     @property
     def parent(self):
@@ -748,12 +883,16 @@ class directory(_BaseFileSystem):
         target_dir = os.path.abspath(destination) + os.sep + current_dir_name
         if current_dir_name not in os.listdir(destination):
             shutil.copytree(self._path, target_dir)
+            listing_cache.invalidate(destination)
         else:
             raise FSError("folder exists, can not override it.")
         return directory(target_dir)
 
     def move(self, destination):
         shutil.move(self._path, destination)
+        listing_cache.invalidate(self._path, recursive = True)
+        listing_cache.invalidate(self.dir)
+        listing_cache.invalidate(destination)
         
     def _diff(self, A, B):
         """ This function only compares B with A, to find if all files in dir A
@@ -817,3 +956,17 @@ class directory(_BaseFileSystem):
         
         
         
+
+
+def _restore(cls, path, size = None, do_walk = None):
+    """Unpickles phile or directory object without touching the disk, see 
+    _BaseFileSystem.__reduce__().
+    """
+    obj = cls.__new__(cls)
+    obj._path = path
+    obj._type = cls._fs_type
+    if size is not None:
+        obj._size = size
+    if do_walk is not None:
+        obj._do_walk = do_walk
+    return obj
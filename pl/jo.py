@@ -27,55 +27,519 @@ Created on : Aug. 2014
 '{}'
 >>> jobj.persons = {"A":{"name":"A", "age":1}, "B":{"name":"B","age":2}}
 >>> 
+
+# Example 4, big json, only wraps the dicts we access
+
+>>> jobj = LazyJsonObject(open('big.json').read())
+>>> print jobj.b.c # only jobj.b is wrapped to a Jo here.
+3
+
+# Example 5, read records from huge json or json-lines file one by one
+
+>>> for jobj in JsonObject.iter_load(open('big.json'), 'items.*'):
+...     print jobj.id
+>>> for jobj in JsonObject.iter_lines(open('log.jsonl')):
+...     print jobj.level
+
+# Example 6, query values from nested dicts and lists
+
+>>> jobj.query("assets[*].files[?size>1000].path")
+['/a/b.ma', '/a/c.ma']
 """
 
 import json
+import re
+import keyword
+import ast
+import sys
+import os
+import timeit
+import marshal
+import mmap
+import struct
+import zlib
+import array
+import itertools
+import collections
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = "ihybrd@gmail.com"
 
 class JoError(Exception):
     """The general Json Object error."""
 
+
+class JsonBackend(object):
+    """ JsonBackend parses and serializes json for Jo. The stdlib json module
+    is always available and used by default, faster modules (orjson, ujson)
+    are registered if they can be imported, they are used only if they are
+    chosen, so the output doesn't depend on what's installed.
+
+    >>> set_backend('orjson') # use orjson globally
+    >>> jo = JsonObject(json_string, backend = 'ujson') # or for one call
+    >>> jo.dumps(backend = 'ujson')
+
+    Only stdlib json supports the separators with spaces and writes the
+    file piece by piece in dump(), the other backends always produce compact
+    json and build the whole string first.
+
+    To add a backend, inherit this class, set name and implement loads() and
+    dumps(), then call register_backend().
+    """
+    name = None
+
+    def loads(self, s):
+        """Returns the python data of json string s."""
+        raise NotImplementedError
+
+    def dumps(self, obj, compact = False, sort_keys = False, indent = None):
+        """Returns the json string of obj, obj may contain Jo and records."""
+        raise NotImplementedError
+
+    def dump(self, obj, fp, compact = False, sort_keys = False, indent = None):
+        """Writes the json string of obj into the file object."""
+        fp.write(self.dumps(obj, compact, sort_keys, indent))
+
+    def __repr__(self):
+        return 'JsonBackend(%s)' % self.name
+
+
+class _JsonBackend(JsonBackend):
+    """stdlib json backend, always available."""
+    name = 'json'
+
+    def loads(self, s):
+        return json.loads(s)
+
+    def dumps(self, obj, compact = False, sort_keys = False, indent = None):
+        return json.dumps(obj, **_dump_options(compact, sort_keys, indent))
+
+    def dump(self, obj, fp, compact = False, sort_keys = False, indent = None):
+        json.dump(obj, fp, **_dump_options(compact, sort_keys, indent))
+
+
+class _UjsonBackend(JsonBackend):
+    """ujson backend, it doesn't know Jo so Jo is converted to dict first."""
+    name = 'ujson'
+
+    def loads(self, s):
+        return ujson.loads(s)
+
+    def dumps(self, obj, compact = False, sort_keys = False, indent = None):
+        return ujson.dumps(_to_plain(obj), sort_keys = sort_keys, 
+                indent = indent or 0, escape_forward_slashes = False)
+
+
+class _OrjsonBackend(JsonBackend):
+    """orjson backend, indent is always 2 if it's given."""
+    name = 'orjson'
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+    def dumps(self, obj, compact = False, sort_keys = False, indent = None):
+        option = 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent is not None:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default = _encode_default, 
+                option = option).decode('utf-8')
+
+
+_backends = {}
+_backend = None
+
+def register_backend(backend, default = False):
+    """Registers a JsonBackend instance, set default True to use it by 
+    default."""
+    global _backend
+    _backends[backend.name] = backend
+    if default or _backend is None:
+        _backend = backend
+
+def set_backend(name):
+    """Sets the default backend by name, see backends()."""
+    global _backend
+    _backend = get_backend(name)
+
+def get_backend(name = None):
+    """Returns the backend by name (or JsonBackend instance), returns the 
+    default backend if name is None."""
+    if name is None:
+        return _backend
+    if isinstance(name, JsonBackend):
+        return name
+    if name not in _backends:
+        raise JoError("JSON backend '%s' is not available" % name)
+    return _backends[name]
+
+def backends():
+    """Returns the names of available backends."""
+    return _backends.keys()
+
+register_backend(_JsonBackend())
+if ujson is not None:
+    register_backend(_UjsonBackend())
+if orjson is not None:
+    register_backend(_OrjsonBackend())
+
+def benchmark(data, number = 10, names = None):
+    """ Measures parse (loads) and serialize (dumps) throughput of backends.
+
+    Args:
+        data: json string, should be a typical document.
+        number: times to run each.
+        names: backend names, all available backends by default.
+    Returns:
+        {name: (loads MB/s, dumps MB/s)}
+    """
+    size = len(data) / 1024.0 / 1024.0 * number
+    ret = {}
+    for name in names or backends():
+        backend = get_backend(name)
+        jo = JsonObject(data, backend = backend)
+        timer = timeit.default_timer
+        start = timer()
+        for i in xrange(number):
+            backend.loads(data)
+        loads_time = timer() - start
+        start = timer()
+        for i in xrange(number):
+            backend.dumps(jo)
+        dumps_time = timer() - start
+        ret[name] = (size / loads_time, size / dumps_time)
+    return ret
+
 class JsonObject(object):
     """ JsonObject ( Jo ) wraps json string or python dictionary. It makes dict
     more like an object, allows you to access a dict via object attribute. It's
     actually working with object.__dict__. It also contains a lot of handy 
     function to make life easier.
     """
-    def __init__(self, input_data = {}):
+    def __init__(self, input_data = {}, backend = None):
         """Constructor.
 
         Args:
             input_data: dictionroy or json string. An empty {} by default.
+            backend: the JsonBackend name to parse the string, None to use
+                the default backend.
         """
         if type(input_data) == dict:
             self.__dict__ = input_data
         else:
-            self.__dict__ = json.loads(input_data)
+            self.__dict__ = get_backend(backend).loads(input_data)
         self._analyse___dict__()
             
+    @classmethod
+    def iter_load(cls, fp, path = '*', chunk_size = 65536):
+        """ Reads json from a file object incrementally and yields the values
+        selected by path one by one, dicts are yielded as Jo. Only the current
+        record (and a chunk of the file) is kept in memory, so it works with
+        the files bigger than memory.
+
+        >>> # {"items": [{"id": 1}, {"id": 2}, ...]}
+        >>> for jo in JsonObject.iter_load(open('big.json'), 'items.*'):
+        ...     print jo.id
+
+        Args:
+            fp: file object of the json.
+            path: keys separated by '.', '*' selects all items of a list (or
+                all values of a dict), a number selects an item of a list. 
+                '*' by default, which means the file is a list of records.
+            chunk_size: the size of each read from the file.
+        """
+        reader = _StreamReader(fp, chunk_size)
+        keys = path.split('.') if path else []
+        for val in reader.iter_path(keys):
+            yield _wrap(cls, val)
+
+    @classmethod
+    def iter_lines(cls, fp, backend = None):
+        """ Yields records from a json-lines file object (one json per line),
+        dicts are yielded as Jo. Empty lines are ignored.
+        """
+        loads = get_backend(backend).loads
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield _wrap(cls, loads(line))
+
+    @classmethod
+    def load_binary(cls, path, source = None):
+        """ Loads the Jo from the binary file written by dump_binary(). 
+        
+        Args:
+            path: the binary file path.
+            source: the json file the binary was made from, if it's given,
+                JoError is raised when the json file has been changed since.
+        """
+        with open(path, 'rb') as f:
+            try:
+                header, stamp, data = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                raise JoError("Invalid binary Jo file: %s" % path)
+        if header != _BINARY_HEADER:
+            raise JoError("Invalid binary Jo file: %s" % path)
+        if source is not None and stamp != _file_stamp(source):
+            raise JoError("Binary Jo file is out of date: %s" % path)
+        return cls(data)
+
+    @classmethod
+    def load_cached(cls, source, cache_path = None, backend = None):
+        """ Loads json file with a binary cache next to it. If the cache is 
+        up to date it's loaded without parsing json, otherwise the json is 
+        parsed and the cache is written again.
+
+        Args:
+            source: the json file path.
+            cache_path: the binary cache path, $source.jobin by default.
+            backend: the JsonBackend name to parse the json.
+        """
+        cache_path = cache_path or source + '.jobin'
+        try:
+            return cls.load_binary(cache_path, source)
+        except (IOError, OSError, JoError):
+            pass
+        # stamp before reading, if the source is changed while it's parsed,
+        # the cache is stale and it's parsed again next time.
+        stamp = _file_stamp(source)
+        with open(source, 'rb') as f:
+            jo = cls(f.read(), backend = backend)
+        try:
+            jo._dump_binary(cache_path, stamp)
+        except (IOError, OSError):
+            pass # read-only location, works without cache.
+        return jo
+
+    @classmethod
+    def load_records(cls, data, backend = None):
+        """ Loads a list of records which (mostly) have same keys. Records 
+        with same keys share one generated JoRecord class which uses 
+        __slots__ instead of __dict__, so each record only keeps its values, 
+        it takes much less memory than Jo. The values are still accessed by 
+        record.attr. Nested dicts (also the ones in lists) are converted in 
+        the same way.
+
+        Records whose keys can't be attribute names are loaded as Jo.
+
+        Args:
+            data: json string of a list, or an iterable of dicts.
+            backend: the JsonBackend name to parse the string.
+        Returns:
+            a list of records.
+        """
+        if isinstance(data, basestring):
+            data = get_backend(backend).loads(data)
+        return [_to_record(cls, d) for d in data]
+
+    @classmethod
+    def query_many(cls, objs, expr):
+        """ Evaluates the query on a list of Jo, returns all the results in 
+        one list. A filter at the beginning filters the Jo themselves:
+
+        >>> JsonObject.query_many(jos, "[?type=='mesh'].name")
+
+        Args:
+            objs: list of Jo (or records, dicts).
+            expr: query expression, see query().
+        """
+        return Query.compile(expr).evaluate(objs)
+
+    @classmethod
+    def to_columns(cls, objs, fields = None, dtypes = None):
+        """ Converts a list of Jo (or records, dicts) to numpy arrays, one 
+        array per field, in one pass. Nested dicts are flattened to paths 
+        like 'a.b'. The dtype of each field is inferred from all the values:
+
+            bool -> bool, int -> int64, int and float -> float64, 
+            string -> unicode, others (list, mixed) -> object.
+
+        Missing values are NaN in float columns (int column with missing 
+        values becomes float64) and None in object columns. Int columns with
+        values out of int64 range are object columns. JoError is raised if 
+        a record has a path twice (key 'a.b' and {'a': {'b': ..}}).
+
+        >>> cols = JsonObject.to_columns(jos)
+        >>> cols['size'][cols['type'] == 'mesh'].sum()
+
+        Args:
+            objs: list of Jo, records or dicts.
+            fields: list of paths to export, all the paths by default.
+            dtypes: {path: dtype} to override the inferred dtypes.
+        Returns:
+            OrderedDict {path: numpy array}, paths in the order first seen.
+        """
+        if numpy is None:
+            raise JoError("numpy is required by to_columns().")
+        values = collections.OrderedDict()
+        types = {}
+        count = 0
+        if fields is not None:
+            for path in fields:
+                values[path] = []
+                types[path] = set()
+            keys = [(path, path.split('.')) for path in fields]
+        for obj in objs:
+            if fields is None:
+                items = []
+                _flatten(obj, '', items)
+            else:
+                items = [(path, _get_path(obj, ks)) for path, ks in keys]
+            for path, val in items:
+                if path not in values:
+                    values[path] = []
+                    types[path] = set()
+                column = values[path]
+                if len(column) > count: # 'a.b' key and {'a': {'b': ..}}
+                    raise JoError("Field '%s' appears twice in record %d" %
+                            (path, count))
+                if len(column) < count: # missing in some records
+                    column.extend([None] * (count - len(column)))
+                    types[path].add(type(None))
+                column.append(val)
+                types[path].add(type(val))
+            count += 1
+        ret = collections.OrderedDict()
+        for path, column in values.iteritems():
+            if len(column) < count:
+                column.extend([None] * (count - len(column)))
+                types[path].add(type(None))
+            dtype = (dtypes or {}).get(path)
+            if dtype is None:
+                dtype = _infer_dtype(types[path])
+                if dtype is numpy.int64 and not all(
+                        _INT64_MIN <= v <= _INT64_MAX for v in column):
+                    dtype = object # too big for int64, keep python longs
+            try:
+                ret[path] = _to_array(column, dtype)
+            except (ValueError, TypeError, OverflowError), e:
+                raise JoError("Can't convert field '%s' to %s: %s" % (path, 
+                        dtype, e))
+        return ret
+
+    @classmethod
+    def to_record_array(cls, objs, fields = None, dtypes = None):
+        """ Same as to_columns() but returns one numpy structured array, the
+        field names are the paths.
+
+        >>> arr = JsonObject.to_record_array(jos)
+        >>> arr[arr['size'] > 1000]['path']
+        """
+        columns = cls.to_columns(objs, fields, dtypes)
+        size = len(columns.values()[0]) if columns else 0
+        arr = numpy.empty(size, dtype = [(_field_name(path), col.dtype) 
+                for path, col in columns.iteritems()])
+        for path, col in columns.iteritems():
+            arr[_field_name(path)] = col
+        return arr
+
+    def query(self, expr):
+        """ Returns a list of values selected by the query expression. The 
+        expression is compiled once and cached by the string.
+
+        >>> jo.query("assets[*].files[?size>1000].path")
+
+        Syntax:
+            a.b       : key b of key a.
+            a[*]      : all items of list a.
+            a[0]      : first item of list a (negative index is ok).
+            a[?b>1]   : items of list a whose key b > 1. Operators are ==, 
+                        !=, <, <=, >, >=, values can be number, 'string', 
+                        true, false or null. [?b] keeps items b is true.
+        """
+        return Query.compile(expr).evaluate([self])
+
+    def dump_binary(self, path, source = None):
+        """ Writes the Jo into a binary file (marshal), which is much faster to
+        load than json. The format depends on the python version, it's only
+        meant to be a cache.
+
+        Args:
+            path: the binary file path.
+            source: the json file of the Jo, its mtime and size are saved to
+                validate the binary when loading.
+        """
+        self._dump_binary(path, 
+                _file_stamp(source) if source is not None else None)
+
+    def _dump_binary(self, path, stamp):
+        """Writes the binary file with the (mtime, size) stamp of source."""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            marshal.dump((_BINARY_HEADER, stamp, self.to_dict()), f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError: # windows can't rename to an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+
+    def diff(self, other):
+        """ Returns the JSON Patch (RFC 6902) which changes self to other, a 
+        list of operations like {"op": "replace", "path": "/a/b", "value": 1}.
+        Sub trees which are the same object in both Jo (e.g. shared by 
+        deep_merge()) are skipped without comparing. Lists are compared item
+        by item, items are added or removed at the end.
+
+        Args:
+            other: Jo or dict.
+        """
+        ops = []
+        _diff(self, other, '', ops)
+        return ops
+
+    def apply(self, patch):
+        """ Applies the JSON Patch (RFC 6902) to the Jo in place. Operations
+        add, remove, replace, move, copy and test are supported. If an
+        operation fails, JoError is raised and the operations before it have
+        been applied already.
+
+        Args:
+            patch: list of operations or the json string of it.
+        """
+        if isinstance(patch, basestring):
+            patch = get_backend().loads(patch)
+        for op in patch:
+            _apply_op(self, op)
+
     def _analyse___dict__(self):
         """ Analyses the __dict__ if there is value with the type of dict, it 
-        will be iterately creating JsonObject.
+        will be iterately creating JsonObject. Lists are wrapped by JoList, 
+        the dicts in the lists are converted when they are accessed.
         """
         for key in self.__dict__:
             val = self.__dict__[key]
             if type(val) == dict:
                 jo = JsonObject(val)
                 self.__dict__[key] = jo
+            elif type(val) == list:
+                self.__dict__[key] = JoList(val, JsonObject)
                 
     def __add__(self, other):
-        """ Merges with another Jo, a new Jo will be returned."""
+        """ Merges with another Jo, a new Jo will be returned. The values are
+        shared with the 2 Jo, not copied.
+        """
         if not self._validate_type(other):
             raise JoError("JsonObject is required.")
         if not self._validate_keys_conflict(other):
             raise JoError("Keys conflict! 2 Jo has same key name.")
-        new_dict = {} # init a new dict
-        for k in self.ls():
-            new_dict[k] = self.__dict__[k]
-        for k in other.ls():
-            new_dict[k] = other.__dict__[k]
-        return JsonObject(new_dict)            
+        new_dict = dict(self.__dict__)
+        new_dict.update(other.__dict__)
+        return _new_jo(self.__class__, new_dict)
 
     def __repr__(self):
         return str(self.__dict__)
@@ -92,12 +556,7 @@ class JsonObject(object):
         """ Returns False if current Jo contains keys that input Jo has, 
         otherwise returns True.
         """
-        ret = True
-        for i in self.ls():
-            if i in obj.ls():
-                ret = False
-                break
-        return ret
+        return not (self.__dict__.viewkeys() & obj.__dict__.viewkeys())
     
     def ls(self):
         """ Returns the keys in current JsonObject (a list of string) """
@@ -106,6 +565,31 @@ class JsonObject(object):
     def merge(self, jo):
         """ Merges with another Jo, a new Jo will be returned."""
         return self.__add__(jo)
+
+    def deep_merge(self, other, conflict = 'override'):
+        """ Merges another Jo (or dict) into a new Jo recursively, the nested
+        Jo with same key are merged as well. Neither of the 2 Jo is changed.
+        The sub trees that are not touched by other are shared with the new 
+        Jo rather than copied, so it costs about the size of other.
+
+        >>> base = JsonObject({"a": {"b": 1, "c": 2}, "d": 3})
+        >>> base.deep_merge({"a": {"c": 4}}).to_json_string(True)
+        '{"a": {"c": 4, "b": 1}, "d": 3}'
+
+        Args:
+            other: Jo or dict.
+            conflict: what to do if both have a key which is not dict:
+                'override': use the value of other (default).
+                'keep': keep the value of self.
+                'error': raise JoError.
+                or a function f(path, val, other_val) returns the value, path
+                is the tuple of keys.
+        """
+        if not (self._validate_type(other) or type(other) == dict):
+            raise JoError("JsonObject or dict is required.")
+        if not callable(conflict) and conflict not in _merge_policies:
+            raise JoError("Unknown conflict policy '%s'" % conflict)
+        return _deep_merge(self.__class__, self, other, conflict, ())
         
     def add(self, key, val, dict_to_jo = True):
         """ Adds new attribute to the Json Object.
@@ -120,7 +604,9 @@ class JsonObject(object):
             raise JoError("JsonObject already contains the key '%s'" % key)
         if dict_to_jo:
             if type(val) == dict:
-                val = JsonObject(val)
+                val = self.__class__(val)
+            elif type(val) == list:
+                val = JoList(val, self.__class__)
         self.__dict__[key] = val
         
     def remove(self, key):
@@ -150,7 +636,9 @@ class JsonObject(object):
             raise JoError("JsonObject doesn't contain the key '%s'" % key)
         if dict_to_jo:
             if type(val) == dict:
-                val = JsonObject(val)
+                val = self.__class__(val)
+            elif type(val) == list:
+                val = JoList(val, self.__class__)
         self.__dict__[key] = val
         
     def has_key(self, key):
@@ -158,23 +646,1231 @@ class JsonObject(object):
         return key in self.ls()
         
     def to_json_string(self, convert_to_str = False):
-        """Returns the json string by analysing object.__dict__
+        """Returns the json data of the Jo, the Jo itself won't be changed.
         
         Args:
-            convert_to_str: True to convert return value to string, otherwise
-                returns raw dict.
-        """
-        def _it_jo(jo):
-            """iterates Jo to get dict info"""
-            for k in jo.__dict__:
-                val = jo.__dict__[k] # get value
-                if isinstance(val, JsonObject): # if val is Jo
-                    jo.__dict__[k] = _it_jo(val) # convert Jo to dict
-            return jo.__dict__ # returns its dict anyway
-        json_data = _it_jo(self)
-        self.update()
+            convert_to_str: True to convert return value to json string, 
+                otherwise returns a plain dict (a copy).
+        """
         if convert_to_str:
-            return str(json_data)
+            return self.dumps()
         else:
-            return json_data
-            
+            return self.to_dict()
+
+    def to_dict(self):
+        """Returns the Jo in plain python dict. Nested Jo are converted to 
+        dicts as well, it's a copy so the Jo is not changed.
+        """
+        return _to_plain(self)
+
+    def dumps(self, compact = False, sort_keys = False, indent = None, 
+            backend = None):
+        """Returns the json string of the Jo.
+
+        Args:
+            compact: True to use separators without spaces.
+            sort_keys: True to sort the keys of the output.
+            indent: indent level for pretty print, None for single line.
+            backend: the JsonBackend name, None to use the default backend.
+        """
+        return get_backend(backend).dumps(self, compact, sort_keys, indent)
+
+    def dump(self, fp, compact = False, sort_keys = False, indent = None,
+            backend = None):
+        """Writes the json string of the Jo into a file object. With stdlib
+        json backend, the json is written piece by piece, the whole string is
+        never built in memory.
+
+        Args:
+            fp: file-like object which has write().
+            compact, sort_keys, indent, backend: same as dumps().
+        """
+        get_backend(backend).dump(self, fp, compact, sort_keys, indent)
+
+
+class _JoEncoder(json.JSONEncoder):
+    """ Json encoder which encodes Jo by its __dict__, without converting the
+    nested Jo to dicts first.
+    """
+    def default(self, obj):
+        return _encode_default(obj)
+
+def _encode_default(obj):
+    """Returns the dict of Jo or record for the json encoders."""
+    if isinstance(obj, JsonObject):
+        return obj.__dict__
+    if isinstance(obj, JoRecord):
+        return obj._as_dict()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+def _dump_options(compact, sort_keys, indent):
+    """Returns the kwargs for json.dump() and json.dumps()."""
+    if compact:
+        separators = (',', ':')
+    elif indent is not None:
+        separators = (',', ': ') # no trailing spaces at the end of lines
+    else:
+        separators = (', ', ': ')
+    return {'cls': _JoEncoder, 'separators': separators, 
+            'sort_keys': sort_keys, 'indent': indent}
+
+class JoRecord(object):
+    """ The base class of the record classes generated by 
+    JsonObject.load_records(). A record class has a fixed set of keys in 
+    __slots__, so the record has no __dict__ and new keys can't be added.
+    """
+    __slots__ = ()
+    _record_classes = {} # sorted keys: record class
+
+    def __init__(self, values):
+        for key, val in zip(self.__slots__, values):
+            setattr(self, key, val)
+
+    def __repr__(self):
+        return str(self._as_dict())
+
+    def _as_dict(self):
+        """Returns the values in a dict, nested records are not converted."""
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def ls(self):
+        """ Returns the keys of the record (a list of string) """
+        return list(self.__slots__)
+
+    def has_key(self, key):
+        """Returns True if the record has key otherwise returns False."""
+        return key in self.__slots__
+
+    def to_dict(self):
+        """Returns the record in plain python dict."""
+        return _to_plain(self)
+
+    def dumps(self, compact = False, sort_keys = False, indent = None,
+            backend = None):
+        """Returns the json string of the record, see JsonObject.dumps()."""
+        return get_backend(backend).dumps(self, compact, sort_keys, indent)
+
+    @classmethod
+    def get_class(cls, keys):
+        """Returns the record class for the keys, the class is created at the
+        first time and reused after. Returns None if any of the keys can't be
+        an attribute name.
+        """
+        keys = tuple(sorted(keys))
+        if keys in cls._record_classes:
+            return cls._record_classes[keys]
+        if all(_is_attr_name(k) for k in keys):
+            record_cls = type('JoRecord', (JoRecord,), 
+                    {'__slots__': tuple(str(k) for k in keys)})
+        else:
+            record_cls = None
+        cls._record_classes[keys] = record_cls
+        return record_cls
+
+def _is_attr_name(key):
+    """Returns True if key can be used as the slot name of a record."""
+    try:
+        key = str(key)
+    except UnicodeError:
+        return False
+    return (re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', key) is not None and
+            not keyword.iskeyword(key) and not key.startswith('__') and
+            not hasattr(JoRecord, key))
+
+def _to_record(jo_cls, val):
+    """Converts dict (and nested dicts, also the ones in lists) to record, 
+    falls back to jo_cls if the keys don't fit."""
+    if type(val) == list:
+        return [_to_record(jo_cls, v) for v in val]
+    if type(val) != dict:
+        return val
+    record_cls = JoRecord.get_class(val.keys())
+    if record_cls is None:
+        return jo_cls(val)
+    return record_cls([_to_record(jo_cls, val[k]) 
+            for k in record_cls.__slots__])
+
+class QueryError(JoError):
+    """Invalid query expression."""
+
+_missing = object()
+
+def _get(node, key):
+    """Returns the value of key from Jo, record or dict, or _missing."""
+    if isinstance(node, JsonObject):
+        if key in node.__dict__:
+            return getattr(node, key) # LazyJsonObject wraps the dict.
+    elif isinstance(node, JoRecord):
+        if key in node.__slots__:
+            return getattr(node, key)
+    elif type(node) == dict:
+        return node.get(key, _missing)
+    return _missing
+
+
+class Query(object):
+    """ Compiled query expression, see JsonObject.query() for the syntax. A 
+    query is compiled into a list of steps, each step maps a list of nodes to
+    a new list of nodes, so many objects can be evaluated in one go.
+    """
+    _token = re.compile(r"""\s*(?:
+            (?P<num>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)|
+            (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+            (?P<op>==|!=|<=|>=|<|>|\[\?|\[|\]|\.|\*)|
+            (?P<name>[A-Za-z_]\w*))""", re.X)
+    _literals = {'true': True, 'false': False, 'null': None}
+    _cache = {}
+    _cache_size = 1024
+
+    def __init__(self, expr):
+        self.expr = expr
+        self._tokens = self._tokenize(expr)
+        self._steps = []
+        self._parse()
+        del self._tokens
+
+    @classmethod
+    def compile(cls, expr):
+        """Returns the compiled Query of expr, cached by the string."""
+        query = cls._cache.get(expr)
+        if query is None:
+            query = cls(expr)
+            if len(cls._cache) >= cls._cache_size:
+                cls._cache.clear()
+            cls._cache[expr] = query
+        return query
+
+    def __repr__(self):
+        return 'Query(%r)' % self.expr
+
+    def evaluate(self, nodes):
+        """Evaluates the query on a list of nodes, returns the results."""
+        for step in self._steps:
+            nodes = step(nodes)
+        return nodes
+
+    def __call__(self, obj):
+        return self.evaluate([obj])
+
+    def _tokenize(self, expr):
+        tokens = []
+        pos = 0
+        expr = expr.rstrip()
+        while pos < len(expr):
+            m = self._token.match(expr, pos)
+            if not m:
+                raise QueryError("Invalid query '%s' at %d" % (expr, pos))
+            tokens.append((m.lastgroup, m.group(m.lastgroup)))
+            pos = m.end()
+        return tokens
+
+    def _pop(self, kind = None, value = None):
+        if not self._tokens:
+            raise QueryError("Unexpected end of query '%s'" % self.expr)
+        tok = self._tokens.pop(0)
+        if (kind and tok[0] != kind) or (value and tok[1] != value):
+            raise QueryError("Unexpected '%s' in query '%s'" % (tok[1], 
+                    self.expr))
+        return tok
+
+    def _parse(self):
+        first = True
+        while self._tokens:
+            kind, value = self._pop()
+            if kind == 'op' and value == '.' and not first:
+                kind, value = self._pop('name')
+            if kind == 'name':
+                self._steps.append(_field_step(value))
+            elif value == '[':
+                kind, value = self._pop()
+                if value == '*':
+                    self._steps.append(_all_step)
+                elif kind == 'num' and '.' not in value:
+                    self._steps.append(_index_step(int(value)))
+                else:
+                    raise QueryError("Invalid index '%s' in query '%s'" % (
+                            value, self.expr))
+                self._pop('op', ']')
+            elif value == '[?':
+                self._steps.append(self._parse_filter())
+            else:
+                raise QueryError("Unexpected '%s' in query '%s'" % (value, 
+                        self.expr))
+            first = False
+
+    def _parse_filter(self):
+        keys = [self._pop('name')[1]]
+        while self._tokens and self._tokens[0] == ('op', '.'):
+            self._pop()
+            keys.append(self._pop('name')[1])
+        kind, op = self._pop('op')
+        if op == ']':
+            return _filter_step(keys, None, None)
+        if op not in _compare_ops:
+            raise QueryError("Invalid operator '%s' in query '%s'" % (op, 
+                    self.expr))
+        kind, value = self._pop()
+        if kind in ('num', 'str'):
+            value = ast.literal_eval(value)
+        elif kind == 'name' and value in self._literals:
+            value = self._literals[value]
+        else:
+            raise QueryError("Invalid value '%s' in query '%s'" % (value, 
+                    self.expr))
+        self._pop('op', ']')
+        return _filter_step(keys, op, value)
+
+def _ordered(a, b):
+    """Only numbers with numbers, strings with strings can be ordered."""
+    if isinstance(a, basestring):
+        return isinstance(b, basestring)
+    return (isinstance(a, (int, long, float)) and 
+            isinstance(b, (int, long, float)))
+
+_compare_ops = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: _ordered(a, b) and a < b,
+    '<=': lambda a, b: _ordered(a, b) and a <= b,
+    '>': lambda a, b: _ordered(a, b) and a > b,
+    '>=': lambda a, b: _ordered(a, b) and a >= b,
+}
+
+def _field_step(key):
+    def step(nodes):
+        ret = []
+        for node in nodes:
+            val = _get(node, key)
+            if val is not _missing:
+                ret.append(val)
+        return ret
+    return step
+
+def _all_step(nodes):
+    ret = []
+    for node in nodes:
+        if isinstance(node, (list, tuple)):
+            ret.extend(node)
+    return ret
+
+def _index_step(index):
+    def step(nodes):
+        ret = []
+        for node in nodes:
+            if isinstance(node, (list, tuple)) and -len(node) <= index < len(node):
+                ret.append(node[index])
+        return ret
+    return step
+
+def _filter_step(keys, op, value):
+    compare = _compare_ops.get(op)
+    def match(node):
+        for key in keys:
+            node = _get(node, key)
+            if node is _missing:
+                return False
+        if compare is None:
+            return bool(node)
+        return compare(node, value)
+    def step(nodes):
+        ret = []
+        for node in nodes:
+            if isinstance(node, (list, tuple)): # filters items of the list
+                ret.extend(n for n in node if match(n))
+            elif match(node): # filters the node itself
+                ret.append(node)
+        return ret
+    return step
+
+class FrozenJsonObject(JsonObject):
+    """ FrozenJsonObject is the immutable Jo. All the nested dicts are frozen
+    to FrozenJsonObject and lists to tuples when it's created (the input data
+    isn't changed). Two frozen Jo are equal if they have same content, and
+    the hash is computed from the content once and cached, so it works in 
+    sets, as dict keys or memoisation keys.
+
+    >>> a = FrozenJsonObject('{"a": {"b": [1, 2]}}')
+    >>> b = FrozenJsonObject({"a": {"b": [1, 2]}})
+    >>> a == b, len(set([a, b]))
+    (True, 1)
+    >>> jo = a.thaw() # back to JsonObject which can be changed.
+    """
+    __slots__ = ('_hash',) # not in __dict__, so it's not a key of the Jo
+
+    def __init__(self, input_data = {}, backend = None):
+        """Constructor.
+
+        Args:
+            input_data: dict, Jo or json string.
+            backend: the JsonBackend name to parse the string.
+        """
+        if isinstance(input_data, basestring):
+            input_data = get_backend(backend).loads(input_data)
+        d = _as_mapping(input_data)
+        if d is None:
+            raise JoError("dict, Jo or json string is required.")
+        object.__setattr__(self, '__dict__', 
+                dict((k, _freeze(v)) for k, v in d.iteritems()))
+
+    def _analyse___dict__(self):
+        """ Does nothing, the values are frozen in __init__."""
+
+    def __setattr__(self, name, value):
+        raise JoError("FrozenJsonObject can't be changed.")
+
+    def __delattr__(self, name):
+        raise JoError("FrozenJsonObject can't be changed.")
+
+    def _readonly(self, *args, **kwargs):
+        raise JoError("FrozenJsonObject can't be changed.")
+
+    add = remove = _update = apply = _readonly
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            h = hash(frozenset((k, _json_key(v)) 
+                    for k, v in self.__dict__.iteritems()))
+            object.__setattr__(self, '_hash', h)
+            return h
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, FrozenJsonObject):
+            return NotImplemented
+        if hash(self) != hash(other):
+            return False
+        d, other_d = self.__dict__, other.__dict__
+        if d.viewkeys() != other_d.viewkeys():
+            return False
+        return all(_json_key(v) == _json_key(other_d[k]) 
+                for k, v in d.iteritems())
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    def __add__(self, other):
+        """ Merges with another Jo, a new FrozenJsonObject is returned."""
+        if not self._validate_type(other):
+            raise JoError("JsonObject is required.")
+        if not self._validate_keys_conflict(other):
+            raise JoError("Keys conflict! 2 Jo has same key name.")
+        new_dict = dict(self.__dict__)
+        new_dict.update(other.__dict__)
+        return FrozenJsonObject(new_dict)
+
+    def deep_merge(self, other, conflict = 'override'):
+        """ Same as JsonObject.deep_merge(), returns a FrozenJsonObject. The
+        frozen sub trees are shared."""
+        if not (self._validate_type(other) or type(other) == dict):
+            raise JoError("JsonObject or dict is required.")
+        if not callable(conflict) and conflict not in _merge_policies:
+            raise JoError("Unknown conflict policy '%s'" % conflict)
+        return FrozenJsonObject(_deep_merge(JsonObject, self, other, 
+                conflict, ()))
+
+    def thaw(self):
+        """Returns a JsonObject (not frozen) copy."""
+        return JsonObject(self.to_dict())
+
+    def __reduce__(self):
+        """ Pickles (and copies) the content only, the cached hash can't be
+        set back by __setattr__."""
+        return (FrozenJsonObject, (self.to_dict(),))
+
+def _json_key(val):
+    """Returns the frozen value tagged with its json type, so values equal
+    in python but not in json (true and 1) are different keys.
+    """
+    if isinstance(val, bool):
+        return ('bool', val)
+    if isinstance(val, (int, long, float)):
+        return ('number', val)
+    if isinstance(val, tuple):
+        return ('array', tuple(_json_key(v) for v in val))
+    return ('value', val) # string, null or FrozenJsonObject
+
+def _freeze(val):
+    """Converts val to immutable: dict to FrozenJsonObject, list to tuple."""
+    if isinstance(val, FrozenJsonObject):
+        return val
+    if _as_mapping(val) is not None:
+        return FrozenJsonObject(val)
+    if isinstance(val, (list, tuple)):
+        items = tuple(_freeze(v) for v in _iter_raw(val))
+        if type(val) == tuple and all(a is b for a, b in zip(items, val)):
+            return val # already frozen, share it
+        return items
+    return val
+
+def _iter_raw(seq):
+    """Iterates list or tuple, JoList doesn't wrap the items."""
+    if isinstance(seq, list):
+        return list.__iter__(seq)
+    return iter(seq)
+
+
+class JoList(list):
+    """ JoList is the list in Jo. The dicts (and lists) in it are kept as they
+    are until the item is accessed, then the item is wrapped to Jo (or JoList)
+    and the wrapper replaces the item, so it's wrapped only once. It costs 
+    nothing for a big list of dicts if we don't touch it.
+
+    JoList is a new list with the references of the items, so the original
+    list isn't the one in the Jo (and isn't changed by wrapping), but the 
+    item dicts are shared with it, the wrapper uses the dict as it is.
+    """
+    def __init__(self, items = (), jo_cls = None):
+        """Constructor.
+
+        Args:
+            items: the list.
+            jo_cls: the class to wrap the dicts, JsonObject by default.
+        """
+        list.__init__(self, items)
+        self._jo_cls = jo_cls or JsonObject
+
+    def _item(self, index, val):
+        """Wraps the item at index if it's dict or list."""
+        if type(val) == dict:
+            val = self._jo_cls(val)
+        elif type(val) == list:
+            val = JoList(val, self._jo_cls)
+        else:
+            return val
+        list.__setitem__(self, index, val)
+        return val
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return JoList(list.__getitem__(self, index), self._jo_cls)
+        return self._item(index, list.__getitem__(self, index))
+
+    def __getslice__(self, i, j):
+        return JoList(list.__getslice__(self, i, j), self._jo_cls)
+
+    def __iter__(self):
+        for index, val in enumerate(list.__iter__(self)):
+            yield self._item(index, val)
+
+    def __reversed__(self):
+        for index in xrange(len(self) - 1, -1, -1):
+            yield self._item(index, list.__getitem__(self, index))
+
+    def pop(self, index = -1):
+        val = list.pop(self, index)
+        if type(val) == dict:
+            return self._jo_cls(val)
+        elif type(val) == list:
+            return JoList(val, self._jo_cls)
+        return val
+
+def _new_jo(cls, d):
+    """Creates Jo of cls with dict d, the values in d are used as they are
+    without analysing."""
+    jo = cls.__new__(cls)
+    object.__setattr__(jo, '__dict__', d)
+    return jo
+
+def _jo_value(cls, val):
+    """Wraps dict and list to the value type used in Jo of cls."""
+    if type(val) == dict:
+        return cls(val)
+    elif type(val) == list:
+        return JoList(val, cls)
+    return val
+
+def _merge_conflict(path, val, other_val):
+    raise JoError("Keys conflict! '%s' exists in both Jo." % '.'.join(path))
+
+_merge_policies = {
+    'override': lambda path, val, other_val: other_val,
+    'keep': lambda path, val, other_val: val,
+    'error': _merge_conflict,
+}
+
+def _deep_merge(cls, base, other, conflict, path):
+    """Returns a new Jo of cls which is base deep merged with other."""
+    if isinstance(base, JsonObject):
+        base = base.__dict__
+    if isinstance(other, JsonObject):
+        other = other.__dict__
+    resolve = conflict if callable(conflict) else _merge_policies[conflict]
+    new_dict = dict(base)
+    for key, other_val in other.iteritems():
+        if key not in new_dict:
+            new_dict[key] = _jo_value(cls, _own(other_val))
+            continue
+        val = new_dict[key]
+        if val is other_val:
+            continue
+        if (isinstance(val, (dict, JsonObject)) and 
+                isinstance(other_val, (dict, JsonObject))):
+            new_dict[key] = _deep_merge(cls, val, other_val, conflict, 
+                    path + (key,))
+        else:
+            ret = resolve(path + (key,), val, other_val)
+            if ret is other_val:
+                ret = _own(ret)
+            new_dict[key] = _jo_value(cls, ret)
+    return _new_jo(cls, new_dict)
+
+def _own(val):
+    """Returns a copy of the plain dict or list of the other Jo, wrapping it
+    into Jo would change it in place (Jo values are shared as they are)."""
+    if type(val) == dict or isinstance(val, list):
+        return _to_plain(val)
+    return val
+
+def _escape(key):
+    """Escapes a key as a json pointer token."""
+    return unicode(key).replace('~', '~0').replace('/', '~1')
+
+def _as_mapping(val):
+    """Returns the dict of Jo, record or dict, None for other types."""
+    if isinstance(val, JsonObject):
+        return val.__dict__
+    elif isinstance(val, JoRecord):
+        return val._as_dict()
+    elif type(val) == dict:
+        return val
+    return None
+
+def _diff(a, b, path, ops):
+    """Appends the operations changing a to b into ops."""
+    if a is b:
+        return
+    if (isinstance(a, FrozenJsonObject) and isinstance(b, FrozenJsonObject) 
+            and a == b): # compared by the cached hashes first
+        return
+    a_dict, b_dict = _as_mapping(a), _as_mapping(b)
+    if a_dict is not None and b_dict is not None:
+        for key in a_dict:
+            if key not in b_dict:
+                ops.append({'op': 'remove', 'path': path + '/' + _escape(key)})
+        for key, val in b_dict.iteritems():
+            sub_path = path + '/' + _escape(key)
+            if key in a_dict:
+                _diff(a_dict[key], val, sub_path, ops)
+            else:
+                ops.append({'op': 'add', 'path': sub_path, 
+                        'value': _to_plain(val)})
+    elif isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        common = min(len(a), len(b))
+        for i in xrange(common): # raw items, no wrapping for JoList
+            _diff(_raw_item(a, i), _raw_item(b, i), '%s/%d' % (path, i), ops)
+        for i in xrange(len(a) - 1, common - 1, -1):
+            ops.append({'op': 'remove', 'path': '%s/%d' % (path, i)})
+        for i in xrange(common, len(b)):
+            ops.append({'op': 'add', 'path': '%s/%d' % (path, i), 
+                    'value': _to_plain(_raw_item(b, i))})
+    elif a != b or isinstance(a, bool) != isinstance(b, bool):
+        ops.append({'op': 'replace', 'path': path, 'value': _to_plain(b)})
+
+def _raw_item(seq, index):
+    """Returns the item of list or tuple, JoList doesn't wrap it."""
+    if isinstance(seq, list):
+        return list.__getitem__(seq, index)
+    return seq[index]
+
+def _pointer(path):
+    """Splits json pointer into a list of keys."""
+    if path == '':
+        return []
+    if not path.startswith('/'):
+        raise JoError("Invalid json pointer '%s'" % path)
+    return [t.replace('~1', '/').replace('~0', '~') 
+            for t in path[1:].split('/')]
+
+def _list_index(container, key, insert = False):
+    """Returns the list index of the pointer token."""
+    size = len(container) + (1 if insert else 0)
+    if insert and key == '-':
+        return len(container)
+    if not key.isdigit() or int(key) >= size:
+        raise JoError("Invalid list index '%s'" % key)
+    return int(key)
+
+def _child(container, key):
+    """Returns the child of Jo, record, dict or list by the pointer token."""
+    if isinstance(container, list):
+        return container[_list_index(container, key)]
+    if isinstance(container, (JsonObject, JoRecord)):
+        val = _get(container, key)
+    elif type(container) == dict:
+        val = container.get(key, _missing)
+    else:
+        val = _missing
+    if val is _missing:
+        raise JoError("Path doesn't exist: '%s'" % key)
+    return val
+
+def _resolve(root, keys):
+    for key in keys:
+        root = _child(root, key)
+    return root
+
+def _set_child(container, key, val, insert):
+    """Adds (insert is True) or replaces the child of the container."""
+    if isinstance(container, list):
+        index = _list_index(container, key, insert)
+        if insert:
+            list.insert(container, index, val)
+        else:
+            list.__setitem__(container, index, val)
+    elif isinstance(container, JsonObject):
+        if not insert and key not in container.__dict__:
+            raise JoError("Path doesn't exist: '%s'" % key)
+        container.__dict__[key] = _jo_value(container.__class__, val)
+    elif isinstance(container, JoRecord):
+        if key not in container.__slots__:
+            raise JoError("Record doesn't have the key '%s'" % key)
+        setattr(container, key, val)
+    elif type(container) == dict:
+        if not insert and key not in container:
+            raise JoError("Path doesn't exist: '%s'" % key)
+        container[key] = val
+    else:
+        raise JoError("Can't set '%s' of %s" % (key, type(container)))
+
+def _remove_child(container, key):
+    """Removes the child of the container and returns it."""
+    val = _child(container, key)
+    if isinstance(container, list):
+        list.__delitem__(container, _list_index(container, key))
+    elif isinstance(container, JsonObject):
+        del container.__dict__[key]
+    elif type(container) == dict:
+        del container[key]
+    else:
+        raise JoError("Can't remove '%s' of %s" % (key, type(container)))
+    return val
+
+def _apply_op(root, op):
+    """Applies one JSON Patch operation to the Jo root."""
+    name = op.get('op')
+    if 'path' not in op:
+        raise JoError("'path' is required by '%s'" % name)
+    keys = _pointer(op['path'])
+    if name in ('add', 'replace', 'test'):
+        if 'value' not in op:
+            raise JoError("'value' is required by '%s'" % name)
+        val = op['value']
+    elif name in ('move', 'copy'):
+        if not op.get('from'):
+            raise JoError("'from' is required by '%s'" % name)
+        from_keys = _pointer(op['from'])
+        if name == 'move':
+            if keys[:len(from_keys)] == from_keys and keys != from_keys:
+                raise JoError("Can't move '%s' into itself" % op['from'])
+            _move(root, from_keys, keys)
+            return
+        val = _resolve(root, from_keys)
+    elif name != 'remove':
+        raise JoError("Unknown patch operation '%s'" % name)
+
+    if name == 'test':
+        # tagged, so true doesn't pass the test of 1
+        if _json_key(_freeze(_resolve(root, keys))) != _json_key(_freeze(val)):
+            raise JoError("Test failed: '%s'" % op['path'])
+        return
+    if name == 'remove':
+        if not keys:
+            raise JoError("Can't remove the root")
+        _remove_child(_resolve(root, keys[:-1]), keys[-1])
+        return
+    val = _to_plain(val) # copy, so the patch isn't shared with the Jo
+    if not keys:
+        _set_root(root, val)
+        return
+    _set_child(_resolve(root, keys[:-1]), keys[-1], val, name != 'replace')
+
+def _move(root, from_keys, keys):
+    """Moves the value at from_keys to keys. The target parent is resolved
+    before the value is removed, and the value is put back if it can't be
+    added there, so a failed move doesn't lose it."""
+    from_parent = _resolve(root, from_keys[:-1])
+    parent = _resolve(root, keys[:-1]) if keys else None
+    val = _remove_child(from_parent, from_keys[-1])
+    try:
+        if parent is None:
+            _set_root(root, _to_plain(val))
+        else:
+            _set_child(parent, keys[-1], _to_plain(val), True)
+    except JoError:
+        _set_child(from_parent, from_keys[-1], val, True)
+        raise
+
+def _set_root(root, val):
+    """Replaces the content of the Jo root by the dict."""
+    if type(val) != dict:
+        raise JoError("The root can only be replaced by a dict")
+    root.__dict__ = val
+    root._analyse___dict__()
+
+_BINARY_HEADER = ('pl.jo', 1, sys.version_info[:2])
+
+def _file_stamp(path):
+    """Returns (mtime, size) of the file."""
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+class JoStore(object):
+    """ JoStore is a read-only store of a huge json dict, values are looked up
+    by key without loading the whole json. It's built once from the json file
+    into 2 files: the data file ($path) keeps keys and values (marshal), the 
+    index file ($path.idx) is a hash table of the offsets. Both are opened by
+    mmap, so a lookup only reads the pages it needs, and only the requested
+    value is decoded.
+
+    >>> JoStore.build('catalogue.json', 'catalogue.store') # once
+    >>> store = JoStore('catalogue.store')
+    >>> print store.asset_0001.name
+    >>> print store['asset-0002'].name
+    >>> 'asset_0003' in store
+    True
+
+    The files depend on the python version (marshal), rebuild them if python
+    is changed. If the json has duplicate keys, the first one is used.
+    """
+    _data_header = struct.Struct('<8sII')
+    _index_header = struct.Struct('<8sIIQQ')
+    _slot = struct.Struct('<QQ') # (hash, entry offset + 1)
+    _entry = struct.Struct('<II') # (key size, value size)
+    _magic = 'PLJOSTOR'
+    _version = 1
+    _pyversion = sys.version_info[0] * 100 + sys.version_info[1]
+
+    def __init__(self, path, jo_cls = None):
+        """Opens the store.
+
+        Args:
+            path: the data file path given to build().
+            jo_cls: the class to wrap dict values, JsonObject by default.
+        """
+        self._jo_cls = jo_cls or JsonObject
+        self._data_file = open(path, 'rb')
+        self._index_file = open(path + '.idx', 'rb')
+        self._data = mmap.mmap(self._data_file.fileno(), 0, 
+                access = mmap.ACCESS_READ)
+        self._index = mmap.mmap(self._index_file.fileno(), 0, 
+                access = mmap.ACCESS_READ)
+        magic, version, pyversion, self._slot_count, self._size = \
+                self._index_header.unpack_from(self._index, 0)
+        data_header = self._data_header.unpack_from(self._data, 0)
+        if (magic, version) != (self._magic, self._version) or \
+                data_header[:2] != (magic, version):
+            self.close()
+            raise JoError("Invalid JoStore: %s" % path)
+        if pyversion != self._pyversion:
+            self.close()
+            raise JoError("JoStore was built by another python version, "
+                    "please rebuild it: %s" % path)
+
+    @classmethod
+    def build(cls, source, path, chunk_size = 65536):
+        """ Builds the store from a json file which is a dict. The json is 
+        read incrementally, only one value is in memory at a time.
+
+        Args:
+            source: the json file path.
+            path: the data file path of the store, the index is $path.idx
+            chunk_size: the size of each read from the json file.
+        """
+        # 'L' may be 32 bit (windows), offsets are kept in 'd' which holds
+        # integers up to 2**53 exactly.
+        hashes = array.array('L')
+        offsets = array.array('d')
+        with open(source, 'rb') as src, open(path, 'wb') as data:
+            data.write(cls._data_header.pack(cls._magic, cls._version, 
+                    cls._pyversion))
+            offset = cls._data_header.size
+            for key, val in _StreamReader(src, chunk_size).iter_items():
+                key = key.encode('utf-8')
+                val = marshal.dumps(val)
+                data.write(cls._entry.pack(len(key), len(val)))
+                data.write(key)
+                data.write(val)
+                hashes.append(_key_hash(key))
+                offsets.append(offset)
+                offset += cls._entry.size + len(key) + len(val)
+        slot_count = 8
+        while slot_count < len(hashes) * 2: # load factor <= 0.5
+            slot_count *= 2
+        table_hashes = array.array('L', [0]) * slot_count
+        table_offsets = array.array('d', [0]) * slot_count
+        mask = slot_count - 1
+        for key_hash, offset in itertools.izip(hashes, offsets):
+            i = key_hash & mask
+            while table_offsets[i]:
+                i = (i + 1) & mask
+            table_hashes[i] = key_hash
+            table_offsets[i] = offset + 1
+        with open(path + '.idx', 'wb') as index:
+            index.write(cls._index_header.pack(cls._magic, cls._version, 
+                    cls._pyversion, slot_count, len(hashes)))
+            pack = cls._slot.pack
+            for i in xrange(slot_count):
+                index.write(pack(table_hashes[i], int(table_offsets[i])))
+
+    def _find(self, key):
+        """Returns the entry offset of the key, -1 if it doesn't exist."""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        key_hash = _key_hash(key)
+        mask = self._slot_count - 1
+        i = key_hash & mask
+        base = self._index_header.size
+        while True:
+            slot_hash, offset = self._slot.unpack_from(self._index, 
+                    base + i * self._slot.size)
+            if not offset:
+                return -1
+            if slot_hash == key_hash:
+                offset -= 1
+                key_size = self._entry.unpack_from(self._data, offset)[0]
+                start = offset + self._entry.size
+                if self._data[start:start + key_size] == key:
+                    return offset
+            i = (i + 1) & mask
+
+    def _value(self, offset):
+        key_size, val_size = self._entry.unpack_from(self._data, offset)
+        start = offset + self._entry.size + key_size
+        return _jo_value(self._jo_cls, 
+                marshal.loads(self._data[start:start + val_size]))
+
+    def get(self, key, default = None):
+        """Returns the value of key, default if the key doesn't exist."""
+        offset = self._find(key)
+        if offset < 0:
+            return default
+        return self._value(offset)
+
+    def __getitem__(self, key):
+        offset = self._find(key)
+        if offset < 0:
+            raise KeyError(key)
+        return self._value(offset)
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        offset = self._find(key)
+        if offset < 0:
+            raise AttributeError(key)
+        return self._value(offset)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def has_key(self, key):
+        """Returns True if the store has the key otherwise returns False."""
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return self._size
+
+    def iterkeys(self):
+        """Yields the keys in the json order, it reads the whole data file."""
+        offset = self._data_header.size
+        end = len(self._data)
+        while offset < end:
+            key_size, val_size = self._entry.unpack_from(self._data, offset)
+            start = offset + self._entry.size
+            yield self._data[start:start + key_size].decode('utf-8')
+            offset = start + key_size + val_size
+
+    def ls(self):
+        """Returns all the keys (a list of string)."""
+        return list(self.iterkeys())
+
+    def close(self):
+        """Closes the mmap and files."""
+        for f in ('_data', '_index', '_data_file', '_index_file'):
+            obj = self.__dict__.pop(f, None)
+            if obj is not None:
+                obj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _key_hash(key):
+    """Stable hash of key (utf-8 str) across processes."""
+    return zlib.crc32(key) & 0xffffffff
+
+def _flatten(obj, prefix, items):
+    """Appends (path, value) of the leaves of obj into items."""
+    for key, val in _as_mapping(obj).iteritems():
+        if _as_mapping(val) is not None:
+            _flatten(val, prefix + key + '.', items)
+        else:
+            items.append((prefix + key, val))
+
+def _get_path(obj, keys):
+    """Returns the value of keys path in obj, None if it's missing."""
+    for key in keys:
+        obj = _get(obj, key)
+        if obj is _missing:
+            return None
+    return obj
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+def _infer_dtype(types):
+    """Returns numpy dtype for the set of python types of a column."""
+    has_none = type(None) in types
+    types = types - set([type(None)])
+    if not types:
+        return object
+    if types == set([bool]):
+        return object if has_none else bool
+    if types <= set([int, long]):
+        return numpy.float64 if has_none else numpy.int64
+    if types <= set([int, long, float]):
+        return numpy.float64
+    if types <= set([str, unicode]) and not has_none:
+        return unicode
+    return object
+
+def _to_array(column, dtype):
+    """Returns numpy array of the list, lists in object columns are kept as
+    items rather than becoming another dimension."""
+    if numpy.dtype(dtype) != numpy.dtype(object):
+        return numpy.array(column, dtype = dtype)
+    arr = numpy.empty(len(column), dtype = object)
+    for i, val in enumerate(column):
+        arr[i] = val
+    return arr
+
+def _field_name(path):
+    """numpy field name must be str in python 2."""
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+def _wrap(cls, val):
+    """Returns cls(val) if val is a dict, otherwise val itself."""
+    if type(val) == dict:
+        return cls(val)
+    return val
+
+def _to_plain(val):
+    """Converts Jo (and the Jo in dicts or lists) to plain python types."""
+    if isinstance(val, JsonObject):
+        val = val.__dict__
+    elif isinstance(val, JoRecord):
+        val = val._as_dict()
+    if type(val) == dict:
+        return dict((k, _to_plain(v)) for k, v in val.iteritems())
+    elif isinstance(val, list):
+        return [_to_plain(v) for v in list.__iter__(val)] # no wrapping
+    elif type(val) == tuple:
+        return [_to_plain(v) for v in val]
+    else:
+        return val
+
+
+class LazyJsonObject(JsonObject):
+    """ LazyJsonObject works same as JsonObject, except the nested dicts are
+    not wrapped when it's created. A nested dict becomes LazyJsonObject at the
+    first time it's accessed, and the wrapper replaces the dict in __dict__ so
+    it's only created once. It's good for big json which we only read a few
+    values from.
+    """
+    def _analyse___dict__(self):
+        """ Does nothing, dicts are wrapped in __getattribute__ on demand."""
+
+    def __getattribute__(self, name):
+        d = object.__getattribute__(self, '__dict__')
+        if name in d:
+            val = d[name]
+            if type(val) == dict:
+                val = LazyJsonObject(val)
+                d[name] = val
+            elif type(val) == list:
+                val = JoList(val, LazyJsonObject)
+                d[name] = val
+            return val
+        return object.__getattribute__(self, name)
+
+
+_number_chars = frozenset('.eE+-0123456789')
+
+class _StreamReader(object):
+    """ Incremental json reader used by JsonObject.iter_load(). It walks the
+    json structure from a file object, values on the path are decoded by
+    json.JSONDecoder.raw_decode() and the others are skipped without being
+    decoded.
+    """
+    _ws = re.compile(r'[ \t\n\r]*')
+    _special = re.compile(r'["\[\]{}]') # chars matter when skipping
+    _str_special = re.compile(r'["\\]') # chars matter inside a string
+
+    def __init__(self, fp, chunk_size):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size = None):
+        """Reads more data into the buffer, returns False at the end of file.
+        The consumed part of the buffer is dropped.
+        """
+        if self._eof:
+            return False
+        data = self._fp.read(size or self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """Skips white spaces, returns the next char ('' at the end)."""
+        while True:
+            self._pos = self._ws.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _next(self):
+        """Returns the next char (not white space) and moves forward."""
+        c = self._peek()
+        self._pos += 1
+        return c
+
+    def _decode(self):
+        """Decodes the next value. If the value isn't complete in the buffer,
+        reads more (doubling the size read each time) and tries again.
+        """
+        self._peek()
+        while True:
+            try:
+                val, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number may be cut at the end of the buffer, or right 
+                # after '.' or 'e' of it (raw_decode gives the int before)
+                if self._eof or (end < len(self._buf) and not (
+                        isinstance(val, (int, long, float)) and 
+                        self._buf[end] in _number_chars)):
+                    self._pos = end
+                    return val
+            except ValueError, e:
+                if self._eof:
+                    raise JoError("Invalid json: %s" % e)
+            self._fill(max(self._chunk_size, len(self._buf) - self._pos))
+
+    def _skip(self):
+        """Skips the next value without decoding it."""
+        if self._peek() not in ('{', '['):
+            self._decode()
+            return
+        depth = 0
+        in_str = False
+        while True:
+            pattern = self._str_special if in_str else self._special
+            m = pattern.search(self._buf, self._pos)
+            if not m:
+                self._pos = len(self._buf)
+                if not self._fill():
+                    raise JoError("Invalid json: unexpected end of file")
+                continue
+            c = m.group()
+            self._pos = m.end()
+            if c == '\\':
+                if self._pos >= len(self._buf) and not self._fill():
+                    raise JoError("Invalid json: unexpected end of file")
+                self._pos += 1 # skip the escaped char
+            elif c == '"':
+                in_str = not in_str
+            elif c in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _expect(self, chars):
+        c = self._next()
+        if c not in chars:
+            raise JoError("Invalid json: expect %s, got '%s'" % (
+                    ' or '.join("'%s'" % i for i in chars), c))
+        return c
+
+    def iter_items(self):
+        """Yields (key, value) of the dict at the current position."""
+        self._expect(('{',))
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                self._expect(('"',))
+            name = self._decode()
+            self._expect((':',))
+            yield name, self._decode()
+            if self._expect((',', '}')) == '}':
+                return
+
+    def iter_path(self, keys):
+        """Yields the values selected by keys from the current position."""
+        if not keys:
+            yield self._decode()
+            return
+        key, rest = keys[0], keys[1:]
+        c = self._peek()
+        if c == '[':
+            self._pos += 1
+            if self._peek() == ']':
+                self._pos += 1
+                return
+            index = 0
+            while True:
+                if key == '*' or key == str(index):
+                    for val in self.iter_path(rest):
+                        yield val
+                else:
+                    self._skip()
+                if self._expect((',', ']')) == ']':
+                    return
+                index += 1
+        elif c == '{':
+            self._pos += 1
+            if self._peek() == '}':
+                self._pos += 1
+                return
+            while True:
+                if self._peek() != '"':
+                    self._expect(('"',))
+                name = self._decode()
+                self._expect((':',))
+                if key == '*' or key == name:
+                    for val in self.iter_path(rest):
+                        yield val
+                else:
+                    self._skip()
+                if self._expect((',', '}')) == '}':
+                    return
+        else:
+            self._skip() # scalar, nothing on the path
+
+
+if __name__ == '__main__':
+    # python jo.py $json_file [$number], prints the backend benchmark.
+    data = open(sys.argv[1]).read()
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print '%-10s %12s %12s' % ('backend', 'loads MB/s', 'dumps MB/s')
+    for name, (loads, dumps) in sorted(benchmark(data, number).items()):
+        print '%-10s %12.2f %12.2f' % (name, loads, dumps)
@@ -44,34 +44,535 @@ Belows are some more examples of using the class
 ...
 >>> sql.update(User, User.age > 30, User.country == 'china', name='YourName', job = "TA")
 ... UPDATE User SET job='TA',name='YourName' WHERE ((age > 30 AND country='china'))
+...
+>>> sql.select([User.name, Order.total], join = LeftJoin(Order, User.id == Order.user_id))
+... SELECT User.name,Order.total FROM User LEFT JOIN Order ON ((User.id=Order.user_id))
+
+The values are not put into the sql string, they are passed to the db as
+parameters (in the paramstyle of the db, see SQL.__init__), so the same kind
+of query always has the same sql string:
+
+>>> sql.select_sql(User.name, User.age > 30)
+... ('SELECT name FROM User WHERE (age>%s)', [30])
 """
+import bisect
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+import re
+
+class SQLError(Exception):
+    """The general SQL error."""
+
 
 class Column(object):
     """ Column object can compare with others """
 
-    def __init__(self, name, table):
+    def __init__(self, name, table, alias = None):
         self._name = name
         self._path_arr = [table, name]
+        self._alias = alias
+
+    def _compare(self, op, other):
+        if isinstance(other, Column): # e.g. join on User.id == Order.user_id
+            return Condition(_qualified(self), op, other)
+        return Condition(self._name, op, other, self._path_arr[0])
 
     def __lt__(self, other):
-        return self._name + "<" + str(other)
+        return self._compare("<", other)
 
     def __gt__(self, other):
-        return self._name + ">" + str(other)
+        return self._compare(">", other)
 
     def __eq__(self, other):
-        if type(other) == str:
-            other = "'%s'" % other
-        return self._name + "=" + str(other)
+        return self._compare("=", other)
 
     def __ne__(self, other):
-        return self._name + "<>" + str(other)
+        return self._compare("<>", other)
 
     def __le__(self, other):
-        return self._name + "<=" + str(other)
+        return self._compare("<=", other)
 
     def __ge__(self, other):
-        return self._name + ">=" + str(other)
+        return self._compare(">=", other)
+
+    def asc(self):
+        """Ascending order of the column, for order_by."""
+        return Order(self._name, False, self._path_arr[0])
+
+    def desc(self):
+        """Descending order of the column, for order_by."""
+        return Order(self._name, True, self._path_arr[0])
+
+    def label(self, alias):
+        """Returns the column selected as alias (name AS alias)."""
+        return Column(self._name, self._path_arr[0], alias)
+
+
+def _qualified(column):
+    """Returns table.name of the column."""
+    return '%s.%s' % tuple(column._path_arr)
+
+
+class Order(object):
+    """ Order of a column used by order_by, see Column.asc(), Column.desc() """
+
+    def __init__(self, name, desc = False, table = None):
+        self._name = name
+        self._desc = desc
+        self._table = table
+
+
+def _order_shape(order_by, qualify = False):
+    """Returns ((name, desc), ..) of order_by, names are table.name if 
+    qualify is True.
+    """
+    if order_by is None:
+        return ()
+    if not isinstance(order_by, (list, tuple)):
+        order_by = [order_by]
+    shape = []
+    for o in order_by:
+        if isinstance(o, Column):
+            o = o.asc()
+        if isinstance(o, Order):
+            name = o._name
+            if qualify and o._table:
+                name = '%s.%s' % (o._table, name)
+            shape.append((name, o._desc))
+        else: # column name
+            shape.append((str(o), False))
+    return tuple(shape)
+
+
+class Join(object):
+    """ Join of a table used by select(join = ..), the on conditions are 
+    ANDed. See InnerJoin and LeftJoin.
+
+    >>> LeftJoin(Order, User.id == Order.user_id, Order.paid == 1)
+    ... LEFT JOIN Order ON ((User.id=Order.user_id AND Order.paid=1))
+    """
+    kind = 'INNER'
+
+    def __init__(self, table, *on):
+        if isinstance(table, Table):
+            table = table._path_arr[0]
+        if not on:
+            raise SQLError("Join of %s needs on condition" % table)
+        self._table = table
+        self._on = on
+
+
+class InnerJoin(Join):
+    """ INNER JOIN, only rows matched in both tables. """
+    kind = 'INNER'
+
+
+class LeftJoin(Join):
+    """ LEFT JOIN, all rows of the left table, NULL if not matched. """
+    kind = 'LEFT'
+
+
+def _projection(obj, joined = False):
+    """Returns (table, column sql) of the selected Table, Column, sql string 
+    or a list of them. Columns are table.name if there are joins or more
+    than one table. The first Table or Column gives the table of FROM.
+    """
+    items = obj if isinstance(obj, (list, tuple)) else [obj]
+    tables = []
+    for item in items:
+        if isinstance(item, (Table, Column)) and \
+                item._path_arr[0] not in tables:
+            tables.append(item._path_arr[0])
+    if not tables:
+        raise SQLError("No table to select from")
+    if len(tables) > 1 and not joined:
+        raise SQLError("Columns of %s need join" % ','.join(tables))
+    qualify = joined or len(tables) > 1
+    columns = []
+    for item in items:
+        if isinstance(item, Table):
+            columns.append('%s.*' % item._name if qualify else '*')
+        elif isinstance(item, Column):
+            name = _qualified(item) if qualify else item._name
+            if item._alias:
+                name = '%s AS %s' % (name, item._alias)
+            columns.append(name)
+        else: # sql string, e.g. 'COUNT(*) AS n', % isn't a param
+            columns.append(str(item).replace('%', '%%'))
+    return tables[0], ','.join(columns)
+
+def _as_joins(join):
+    """Returns the tuple of joins of the join option."""
+    if not join:
+        return ()
+    if isinstance(join, Join):
+        return (join,)
+    return tuple(join)
+
+def _column_names(obj):
+    """Returns the names of the selected columns, None for '*'."""
+    items = obj if isinstance(obj, (list, tuple)) else [obj]
+    names = []
+    for item in items:
+        if isinstance(item, Table):
+            names.append(None)
+        elif isinstance(item, Column):
+            names.append(item._alias or item._name)
+        else:
+            names.append(str(item).split()[-1])
+    return names
+
+
+class Condition(object):
+    """ Condition is the result of comparing a Column with a value, such as
+    User.age > 10. The value is kept as a parameter rather than being put into
+    the sql string. str(condition) gives the sql with the value in it.
+    """
+
+    def __init__(self, name, op, value, table = None):
+        self._name = name
+        self._op = op
+        self._value = value
+        self._table = table
+
+    @property
+    def shape(self):
+        """The condition without value, same shape gives same sql."""
+        return self.qualified_shape(False)
+
+    def qualified_shape(self, qualify):
+        """The shape, the name is table.name if qualify is True."""
+        name = self._name
+        if qualify and self._table:
+            name = '%s.%s' % (self._table, name)
+        if isinstance(self._value, Column):
+            return (name, self._op, _qualified(self._value))
+        if self._value is None and self._op in ('=', '<>'):
+            return (name, self._op, None)
+        return (name, self._op)
+
+    def params(self):
+        """Returns the list of parameters."""
+        if len(self.shape) == 3:
+            return []
+        return [self._value]
+
+    def __str__(self):
+        return _inline(_condition_sql(self.shape), self.params())
+
+    def __repr__(self):
+        return 'Condition(%s)' % str(self)
+
+
+def _condition_sql(shape):
+    """Returns the sql of the condition shape, value is placeholder %s."""
+    if len(shape) == 3 and shape[2] is not None: # compares with a column
+        return '%s%s%s' % shape
+    if len(shape) == 3: # compares with NULL
+        name, op = shape[:2]
+        return '%s IS %sNULL' % (name, 'NOT ' if op == '<>' else '')
+    return '%s%s%%s' % shape
+
+def _literal(val):
+    """Returns the sql literal of a python value."""
+    if val is None:
+        return 'NULL'
+    elif isinstance(val, bool):
+        return '1' if val else '0'
+    elif isinstance(val, basestring):
+        return "'%s'" % val.replace('\\', '\\\\').replace("'", "''")
+    else:
+        return str(val)
+
+def _inline(sql, params):
+    """Puts the params into the sql (with %s placeholders) as literals. It's
+    only for reading the sql (e.g. str(condition)), statements are always 
+    sent to the db with parameters.
+    """
+    return sql % tuple(_literal(p) for p in params)
+
+def _to_paramstyle(sql, count, style):
+    """Converts the %s placeholders in sql to the DB-API paramstyle."""
+    if style == 'format':
+        return sql
+    if style == 'qmark':
+        marks = ['?'] * count
+    elif style == 'numeric':
+        marks = [':%d' % (i + 1) for i in xrange(count)]
+    elif style == 'named':
+        marks = [':p%d' % i for i in xrange(count)]
+    elif style == 'pyformat':
+        marks = ['%%(p%d)s' % i for i in xrange(count)]
+    else:
+        raise SQLError("Unknown paramstyle '%s'" % style)
+    marks = iter(marks)
+    def replace(m):
+        if m.group() == '%%':
+            return '%%' if style == 'pyformat' else '%'
+        return next(marks)
+    return re.sub('%%|%s', replace, sql)
+
+def _style_params(params, style):
+    """Returns params in the type the paramstyle needs (dict for named)."""
+    if style in ('named', 'pyformat'):
+        return dict(('p%d' % i, p) for i, p in enumerate(params))
+    return params
+
+
+class _LRUCache(object):
+    """ A small thread-safe LRU cache, the least recently used key is dropped
+    when it's full.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            val = self._data.pop(key)
+            self._data[key] = val # move to the end (newest)
+            return val
+
+    def put(self, key, val):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = val
+            while len(self._data) > self.max_size:
+                self._data.popitem(last = False)
+
+    def pop(self, key, default = None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _ResultCache(object):
+    """ Cache of select results, keyed by (sql, params). Each table has a 
+    version which is increased when the table is written, an entry is only 
+    valid if the versions of its tables haven't changed and it's not older 
+    than ttl seconds, so invalidating a table is O(1).
+    """
+    def __init__(self, max_size, ttl):
+        self.ttl = ttl
+        self._entries = _LRUCache(max_size)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def versions(self, tables):
+        """Returns the current versions of the tables."""
+        with self._lock:
+            return tuple((t, self._versions.get(t, 0)) for t in tables)
+
+    def get(self, key):
+        """Returns the cached rows or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expire, versions, rows = entry
+        if time.time() > expire or \
+                versions != self.versions(t for t, _ in versions):
+            self._entries.pop(key)
+            return None
+        return rows
+
+    def put(self, key, versions, rows):
+        """Caches the rows, versions should be got before the query, so rows 
+        selected while the table is being written are not valid.
+        """
+        if self.ttl is not None:
+            expire = time.time() + self.ttl
+        else:
+            expire = float('inf')
+        self._entries.put(key, (expire, versions, rows))
+
+    def invalidate(self, table = None):
+        """Invalidates the entries of the table, or all if table is None."""
+        if table is None:
+            self._entries.clear()
+            return
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _params_key(params):
+    """Returns params as a hashable key, None if they aren't hashable."""
+    if isinstance(params, dict):
+        params = sorted(params.iteritems())
+    key = tuple(params)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class QueryEvent(collections.namedtuple('QueryEvent', ['method', 'sql', 
+        'param_count', 'seconds', 'rows', 'caller', 'error'])):
+    """ The query passed to the hooks of SQL, sql is the statement with 
+    placeholders (the shape of the query), rows is the number of rows got, or
+    the number returned by db.put() if it's an int, otherwise None. caller is
+    'file:line function' of the code which called SQL. The parameters are 
+    in _params (not in repr, so they aren't logged by accident).
+    """
+    _params = None
+
+
+def _caller():
+    """Returns 'file:line function' of the first frame outside this file."""
+    frame = sys._getframe(1)
+    here = os.path.splitext(__file__)[0]
+    while frame is not None and \
+            os.path.splitext(frame.f_code.co_filename)[0] == here:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '%s:%d %s' % (frame.f_code.co_filename, frame.f_lineno, 
+            frame.f_code.co_name)
+
+
+class QueryStats(object):
+    """ QueryStats is a hook of SQL which aggregates the latency of each 
+    statement shape in a histogram and keeps a log of slow queries.
+
+    >>> stats = QueryStats(sql, slow = 0.5, explain = True)
+    >>> ... # run the program
+    >>> for shape in stats.top(10):
+    ...     print shape['sql'], shape['count'], shape['total'], shape['p95']
+    >>> stats.slow_log[-1].caller
+    ... '/tools/report.py:120 main'
+    """
+    # upper bounds (seconds) of the histogram buckets, the last is +inf
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5,
+            10, 30, 60)
+
+    def __init__(self, sql = None, slow = 1.0, slow_log_size = 1000, 
+            log = None, explain = False):
+        """Constructor, it's added to sql as a hook if sql is given.
+
+        Args:
+            sql: the SQL object.
+            slow: seconds, queries not faster than it are slow, None means
+                no slow log.
+            slow_log_size: max number of slow QueryEvents kept in slow_log.
+            log: function called with a message for each slow query, e.g.
+                logger.warning.
+            explain: True to run EXPLAIN of the first slow query of each 
+                select shape, the result is in explains. (The db must 
+                support EXPLAIN, sql is needed.)
+        """
+        self.slow = slow
+        self.log = log
+        self.explain = explain
+        self.slow_log = collections.deque(maxlen = slow_log_size)
+        self.explains = {} # sql: rows of EXPLAIN
+        self._shapes = {}
+        self._lock = threading.Lock()
+        self._sql = sql
+        if sql is not None:
+            sql.add_hook(self)
+
+    def __call__(self, event):
+        with self._lock:
+            shape = self._shapes.get(event.sql)
+            if shape is None:
+                shape = {'sql': event.sql, 'method': event.method, 
+                        'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 
+                        'rows': 0, 'params': 0, 
+                        'histogram': [0] * (len(self.buckets) + 1)}
+                self._shapes[event.sql] = shape
+            shape['count'] += 1
+            shape['total'] += event.seconds
+            shape['max'] = max(shape['max'], event.seconds)
+            shape['rows'] += event.rows or 0
+            shape['params'] += event.param_count
+            if event.error is not None:
+                shape['errors'] += 1
+            shape['histogram'][bisect.bisect_left(self.buckets, 
+                    event.seconds)] += 1
+            is_slow = self.slow is not None and event.seconds >= self.slow
+            if is_slow:
+                self.slow_log.append(event)
+        if not is_slow:
+            return
+        if self.log is not None:
+            self.log('Slow query %.3fs (%s rows) at %s: %s' % (event.seconds,
+                    event.rows, event.caller, event.sql))
+        if self.explain and self._sql is not None and event.method == 'get' \
+                and event.sql not in self.explains and event.error is None:
+            self._explain(event)
+
+    def _explain(self, event):
+        """Runs EXPLAIN of the select with the params of the slow query."""
+        if not event.sql.lstrip().upper().startswith('SELECT'):
+            return
+        self.explains[event.sql] = None # only tried once
+        sql = 'EXPLAIN ' + event.sql
+        try:
+            self.explains[event.sql] = self._sql._db.get(sql, event._params)
+        except Exception, e:
+            self.explains[event.sql] = e
+
+    def percentile(self, sql, p):
+        """Returns the upper bound (seconds) of the histogram bucket that 
+        has the p (0 - 100) percentile latency of the shape.
+        """
+        with self._lock:
+            histogram = list(self._shapes[sql]['histogram'])
+        return self._percentile(histogram, p)
+
+    def _percentile(self, histogram, p):
+        target = sum(histogram) * p / 100.0
+        seen = 0
+        for i, n in enumerate(histogram):
+            seen += n
+            if n and seen >= target:
+                break
+        if i < len(self.buckets):
+            return self.buckets[i]
+        return float('inf')
+
+    def shapes(self):
+        """Returns the stats of each shape: dicts of sql, method, count,
+        errors, total, max, rows, params, histogram (counts of buckets),
+        mean, p50 and p95.
+        """
+        with self._lock:
+            shapes = [dict(s, histogram = list(s['histogram'])) 
+                    for s in self._shapes.itervalues()]
+        for s in shapes:
+            s['mean'] = s['total'] / s['count']
+            s['p50'] = self._percentile(s['histogram'], 50)
+            s['p95'] = self._percentile(s['histogram'], 95)
+        return shapes
+
+    def top(self, n = 10, key = 'total'):
+        """Returns the n shapes which have the biggest key (total time)."""
+        return sorted(self.shapes(), key = lambda s: s[key], reverse = True)[:n]
+
+    def reset(self):
+        """Clears all the stats."""
+        with self._lock:
+            self._shapes.clear()
+            self.slow_log.clear()
+            self.explains.clear()
 
 
 class Table(object):
@@ -85,9 +586,354 @@ class Table(object):
         return Column(column, self._name)
 
 
+# LIMIT without limit of the dialects that need LIMIT for OFFSET
+_no_limit = {'mysql': '18446744073709551615', 'sqlite': '-1'}
+
+# dialect of DB-API modules, see SQL.upsert_many()
+_module_dialects = {'MySQLdb': 'mysql', 'pymysql': 'mysql', 
+        'mysql': 'mysql', 'sqlite3': 'sqlite', 'pysqlite2': 'sqlite', 
+        'psycopg2': 'postgresql', 'pg8000': 'postgresql'}
+
+
+class PooledDB(object):
+    """ PooledDB is a db object for SQL class which keeps a pool of DB-API 2.0
+    connections, so threads can run queries at the same time without opening
+    a connection for each task.
+
+    >>> import MySQLdb
+    >>> db = PooledDB(MySQLdb, host = 'localhost', db = 'test', max_size = 8)
+    >>> sql = SQL(db)
+    >>> sql.select(User.name, User.age > 30) # in any thread
+    ...
+    >>> with db.transaction(): # the block uses one connection
+    ...     sql.insert(User, name = 'A')
+    ...     sql.update(User, User.name == 'A', age = 1)
+
+    sqlite3 connections are used by other threads, so it needs 
+    check_same_thread = False:
+
+    >>> db = PooledDB(sqlite3, 'test.db', check_same_thread = False)
+
+    Each call checks out a connection and returns it to the pool, get() 
+    rolls back and put() commits when it's not in a transaction. In a 
+    transaction, the connection is kept by the thread until it's committed
+    or rolled back. Idle connections are checked by health_check sql before
+    they are used again if they have been idle for health_check_interval.
+    """
+
+    def __init__(self, module, *args, **kwargs):
+        """Constructor, the pool options are taken out from kwargs, the rest
+        args are passed to module.connect().
+
+        Args:
+            module: the DB-API 2.0 module, e.g. MySQLdb, sqlite3.
+            min_size: connections created at the beginning (1).
+            max_size: max number of connections (10).
+            timeout: seconds to wait for a free connection, None to wait 
+                forever (30).
+            health_check: sql to check the connection ('SELECT 1'), None to
+                disable it.
+            health_check_interval: idle seconds before health check (30).
+            stream_cursor: function(connection) returns the cursor used by
+                cursor_get(), e.g. server-side cursor for MySQLdb:
+                lambda conn: conn.cursor(MySQLdb.cursors.SSCursor)
+        """
+        self._module = module
+        self.paramstyle = module.paramstyle
+        self.dialect = _module_dialects.get(module.__name__.split('.')[0])
+        self._min_size = kwargs.pop('min_size', 1)
+        self._max_size = kwargs.pop('max_size', 10)
+        self._timeout = kwargs.pop('timeout', 30)
+        self._health_check = kwargs.pop('health_check', 'SELECT 1')
+        self._health_check_interval = kwargs.pop('health_check_interval', 30)
+        self._stream_cursor = kwargs.pop('stream_cursor', None)
+        self._connect_args = (args, kwargs)
+        self._cond = threading.Condition()
+        self._idle = [] # [(connection, last used time)]
+        self._size = 0
+        self._local = threading.local()
+        self._closed = False
+        for i in xrange(self._min_size):
+            self._size += 1
+            self._idle.append((self._connect(), time.time()))
+
+    def _connect(self):
+        args, kwargs = self._connect_args
+        return self._module.connect(*args, **kwargs)
+
+    def _acquire(self):
+        """Checks out a connection, waits if max_size is reached."""
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise SQLError("The pool is closed.")
+                if self._idle:
+                    conn, last_used = self._idle.pop() # the newest one
+                    break
+                if self._size < self._max_size:
+                    self._size += 1
+                    conn = last_used = None
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise SQLError("No free connection in %s seconds." %
+                                self._timeout)
+                    self._cond.wait(remaining)
+        if conn is None:
+            try:
+                return self._connect()
+            except:
+                self._forget()
+                raise
+        if (self._health_check and 
+                time.time() - last_used > self._health_check_interval and
+                not self._is_healthy(conn)):
+            self._discard(conn)
+            return self._acquire()
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self._health_check)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except self._module.Error:
+            return False
+
+    def _release(self, conn):
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _discard(self, conn):
+        """Closes the broken connection and frees its place in the pool."""
+        try:
+            conn.close()
+        except self._module.Error:
+            pass
+        self._forget()
+
+    def _check_in(self, conn):
+        """Rolls back and returns the connection after an error, or discards
+        it if it's not healthy."""
+        try:
+            conn.rollback()
+        except self._module.Error:
+            self._discard(conn)
+            return
+        if self._health_check and not self._is_healthy(conn):
+            self._discard(conn)
+        else:
+            self._release(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks out a connection for the block. If the thread is in a 
+        transaction, its connection is used.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        try:
+            yield conn
+        except:
+            self._check_in(conn) # the connection may be broken.
+            raise
+        self._release(conn)
+
+    def in_transaction(self):
+        """Returns True if the current thread is in a transaction."""
+        return getattr(self._local, 'conn', None) is not None
+
+    def begin(self):
+        """Begins a transaction, the thread keeps a connection until commit()
+        or rollback()."""
+        if self.in_transaction():
+            raise SQLError("Already in a transaction.")
+        self._local.conn = self._acquire()
+        self._local.callbacks = collections.OrderedDict()
+
+    def on_transaction_end(self, func, *args):
+        """Calls func(*args) after the transaction of the current thread is
+        committed or rolled back, same func and args are called only once.
+        """
+        if not self.in_transaction():
+            raise SQLError("Not in a transaction.")
+        self._local.callbacks[(func, args)] = None
+
+    def _end(self, method):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            raise SQLError("Not in a transaction.")
+        self._local.conn = None
+        callbacks, self._local.callbacks = self._local.callbacks, None
+        try:
+            try:
+                getattr(conn, method)()
+            except:
+                # e.g. deferred constraint fails at commit, or broken 
+                # connection
+                self._check_in(conn)
+                raise
+            self._release(conn)
+        finally:
+            for func, args in callbacks:
+                func(*args)
+
+    def commit(self):
+        """Commits the transaction and returns the connection to the pool."""
+        self._end('commit')
+
+    def rollback(self):
+        """Rolls back the transaction and returns the connection."""
+        self._end('rollback')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the block in a transaction, commits at the end or rolls back
+        if there is an exception."""
+        self.begin()
+        try:
+            yield
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _run(self, sql, params, fetch, many = False):
+        in_transaction = self.in_transaction()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if many:
+                    cursor.executemany(sql, params)
+                else:
+                    cursor.execute(sql, params)
+                rows = cursor.fetchall() if fetch else None
+            finally:
+                cursor.close()
+            if not in_transaction:
+                if fetch:
+                    conn.rollback() # ends the read snapshot
+                else:
+                    conn.commit()
+        return rows
+
+    def get(self, sql, params = ()):
+        """Executes the sql and returns all the rows."""
+        return self._run(sql, params, True)
+
+    def put(self, sql, params = ()):
+        """Executes the sql, commits if it's not in a transaction."""
+        self._run(sql, params, False)
+
+    def put_many(self, sql, seq_of_params):
+        """Executes the sql with each params by cursor.executemany()."""
+        self._run(sql, seq_of_params, False, many = True)
+
+    def cursor_get(self, sql, params = ()):
+        """Executes the sql and returns the cursor to fetch rows from, the 
+        connection is kept until the cursor is closed."""
+        in_transaction = self.in_transaction()
+        if in_transaction:
+            conn = self._local.conn
+        else:
+            conn = self._acquire()
+        try:
+            if self._stream_cursor:
+                cursor = self._stream_cursor(conn)
+            else:
+                cursor = conn.cursor()
+            cursor.execute(sql, params)
+        except:
+            if not in_transaction:
+                self._check_in(conn)
+            raise
+        return _PooledCursor(self, conn, cursor, in_transaction)
+
+    def close(self):
+        """Closes the idle connections, the ones in use are closed when they
+        are returned."""
+        with self._cond:
+            self._closed = True
+            for conn, last_used in self._idle:
+                conn.close()
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
+
+
+class _PooledCursor(object):
+    """Cursor returned by PooledDB.cursor_get(), close() returns the 
+    connection to the pool."""
+
+    def __init__(self, pool, conn, cursor, in_transaction):
+        self._pool = pool
+        self._conn = conn
+        self._cursor = cursor
+        self._in_transaction = in_transaction
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._in_transaction:
+            self._cursor.close()
+            return
+        try:
+            self._cursor.close()
+            conn.rollback() # ends the read transaction of the select
+        except:
+            self._pool._check_in(conn) # the connection may be broken.
+            raise
+        self._pool._release(conn)
+
+
+_row_classes = {}
+
+def row_class(names):
+    """Returns the light weight row class (namedtuple) for the column names,
+    the class is created once for same names. Invalid names are renamed to
+    _0, _1...
+    """
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        cls = collections.namedtuple('Row', names, rename = True)
+        _row_classes[names] = cls
+    return cls
+
+
 class SQL(object):
     
-    def __init__(self, db):
+    def __init__(self, db, paramstyle = None, statement_cache_size = 256,
+            result_cache_size = 0, result_cache_ttl = 60, dialect = None):
         """Initializes the sql object. db object is needed for initialization.
         db object isn't a specific database object, it needs to be defined 
         outside SQL class, SQL class only needs the db.put() and db.get()
@@ -95,25 +941,128 @@ class SQL(object):
         This is an example of having a db class if using MySQLdb module
         
         class DB(object):
+            paramstyle = 'format' # MySQLdb.paramstyle
+
             def __init__(self):
                 # init a mysql db object here.
                 
-            def put(self, sql):
-                # calls sql statement by db.cursor.execute()
+            def put(self, sql, params):
+                # calls db.cursor.execute(sql, params)
                 
-            def get(self, sql):
-                # calls sql statement by db.cursor.execute() and fetchall()
+            def get(self, sql, params):
+                # calls db.cursor.execute(sql, params) and fetchall()
+                
+        These methods are optional, they are used if the db has them:
+
+            def cursor_get(self, sql, params):
+                # executes the sql and returns the cursor, for iter_select()
+
+            def put_many(self, sql, seq_of_params):
+                # calls db.cursor.executemany(sql, seq_of_params)
+
+            def begin(self): / def commit(self): / def rollback(self):
+                # transaction control, e.g. db.conn.commit()
+
+            def in_transaction(self):
+                # True if the thread is in a transaction of the caller
+
+            def on_transaction_end(self, func, *args):
+                # calls func(*args) after commit or rollback, so the result
+                # cache drops what was read before the commit
                 
         So the DB() can be used like this:
         
         >>> db = DB(..) # can be some init info here
         >>> sql = SQL(db)
         >>> sql.select(..) # whatever you wanna do here.
+
+        The values are never put into the sql string, db.get(sql, params) 
+        and db.put(sql, params) always get them as parameters, in 'format' 
+        paramstyle (%s) if the db has no paramstyle. A db whose get() and 
+        put() only take the sql isn't supported any more, they fail with 
+        TypeError.
+
+        The sql strings are cached by the shape of the query (tables, columns
+        and operators, without values), so building same kind of query again
+        is cheap, and the database gets same sql string to reuse its plan.
+
+        If result_cache_size is set, the rows of select() are cached by the 
+        sql and params. insert, update etc. of this object invalidate the 
+        cached results of the table, call invalidate() if the table is 
+        written by others. Results read in a transaction (db.in_transaction())
+        are not cached, and writes in a transaction invalidate the table 
+        again when it ends (db.on_transaction_end()).
         
         Args:
             db: db object. The db object should have API: get() and put()
+            paramstyle: DB-API paramstyle of the db: 'format', 'qmark', 
+                'numeric', 'named' or 'pyformat'. db.paramstyle, or 'format'
+                by default.
+            statement_cache_size: max number of cached sql strings.
+            result_cache_size: max number of cached select results, 0 means
+                no result cache.
+            result_cache_ttl: seconds a cached result is valid, None means
+                until the table is written.
+            dialect: 'mysql', 'postgresql' or 'sqlite', used by the sql 
+                which isn't standard (upsert). db.dialect or 'mysql' by
+                default.
         """
         self._db = db
+        if paramstyle is None:
+            paramstyle = getattr(db, 'paramstyle', None) or 'format'
+        self._paramstyle = paramstyle
+        if dialect is None:
+            dialect = getattr(db, 'dialect', None) or 'mysql'
+        if dialect not in ('mysql', 'postgresql', 'sqlite'):
+            raise SQLError("Unknown dialect '%s'" % dialect)
+        self._dialect = dialect
+        self._statements = _LRUCache(statement_cache_size)
+        self._results = None
+        if result_cache_size > 0:
+            self._results = _ResultCache(result_cache_size, result_cache_ttl)
+        self._hooks = []
+
+    def add_hook(self, hook):
+        """Adds a function called after each db.get/put (and put_many, 
+        cursor_get) with a QueryEvent, e.g. QueryStats. Hooks are called in
+        the thread of the query, exceptions of hooks are not caught.
+        """
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        """Removes the hook added by add_hook()."""
+        self._hooks = [h for h in self._hooks if h is not hook]
+
+    def _call_db(self, method, sql, params, count = None):
+        """Calls db.$method(sql, params) and the hooks."""
+        func = getattr(self._db, method)
+        hooks = self._hooks
+        if not hooks:
+            return func(sql, params)
+        if count is None:
+            count = len(params)
+        start = time.time()
+        error = None
+        result = None
+        try:
+            result = func(sql, params)
+            return result
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            seconds = time.time() - start
+            rows = None
+            if method == 'get' and hasattr(result, '__len__'):
+                rows = len(result)
+            elif isinstance(result, (int, long)) and \
+                    not isinstance(result, bool):
+                rows = result # rowcount if the db returns it
+            event = QueryEvent(method, sql, count, seconds, rows, _caller(),
+                    error)
+            event._params = params
+            for hook in hooks:
+                hook(event)
 
     def _logical_operator(self, arr, counter):
         """This function iterately calls itself to genterate the AND and OR 
@@ -132,7 +1081,7 @@ class SQL(object):
         you can see that Or and And are used alternately by layers.
         
         Args:
-            arr : is the list of condition such as A==B, C<10
+            arr : is the shape of conditions, see _where_shape()
             counter: records the layer of the iteration
         Returns:
             string        
@@ -140,44 +1089,283 @@ class SQL(object):
         counter += 1
         _arr = []
         for a in arr:
-            if type(a) == tuple:
-                ret = self._logical_operator(a, counter)
+            if a[0] == 'group':
+                ret = self._logical_operator(a[1], counter)
                 _arr.append(ret)
+            elif a[0] == 'sql':
+                _arr.append(a[1].replace('%', '%%'))
             else:
-                _arr.append(str(a))
+                _arr.append(_condition_sql(a[1]))
         if counter % 2 == 0:
             ret = '(%s)'%(' AND '.join(_arr))
         else:
             ret = '(%s)'%(' OR '.join(_arr))
         return ret
+
+    def _where_shape(self, where, params, qualify = False):
+        """Returns the shape of the condition tuples (values are replaced by
+        placeholders), the values are appended to params.
+
+        Args:
+            where: the condition tuples, Condition or sql string.
+            params: list to collect the parameters.
+            qualify: True to use table.name for columns (joins).
+        """
+        shape = []
+        for w in where:
+            if type(w) == tuple:
+                shape.append(('group', self._where_shape(w, params, qualify)))
+            elif isinstance(w, Condition):
+                shape.append(('cond', w.qualified_shape(qualify)))
+                params.extend(w.params())
+            else: # sql string, used as it is.
+                shape.append(('sql', str(w)))
+        return tuple(shape)
     
-    def _where(self, *where):
+    def _where(self, shape):
         """Generates WHERE statement.
 
         Args:
-            *where: the condition tuples
+            shape: the shape of the condition tuples.
         Returns:
             where statement.
         """
-        if not where:
+        if not shape:
             where = ""
         else:
-            where = 'WHERE '+ self._logical_operator(where, 0)
+            where = 'WHERE '+ self._logical_operator(shape, 0)
         return where
 
-    def select(self, obj, *where):
+    def _statement(self, key, build, params):
+        """Returns (sql, params) in the paramstyle of the db. The sql string 
+        is cached by key, build() is only called if it's not cached. key None
+        means it's not cached.
+        """
+        style = self._paramstyle
+        sql = None
+        if key is not None:
+            sql = self._statements.get(key)
+        if sql is None:
+            sql = _to_paramstyle(build(), len(params), style)
+            if key is not None:
+                self._statements.put(key, sql)
+        return sql, _style_params(params, style)
+
+    def _execute(self, method, sql, params):
+        """Calls db.get or db.put with (sql, params) and the hooks."""
+        return self._call_db(method, sql, params)
+
+    def select_sql(self, obj, *where, **options):
+        """Returns (sql, params) of select(), see select()."""
+        joins = _as_joins(options.pop('join', None))
+        table, column = _projection(obj, bool(joins))
+        return self._select_sql(table, column, where, joins, **options)
+
+    def _select_sql(self, table, column, where, joins = (), order_by = None,
+            limit = None, offset = None):
+        """Returns (sql, params) of SELECT $column FROM $table."""
+        params = []
+        qualify = bool(joins)
+        # params are in the order of the sql, ON conditions go first.
+        join_shape = tuple((j.kind, j._table, 
+                self._where_shape((j._on,), params, True)) for j in joins)
+        shape = self._where_shape((where,) if where else (), params, qualify)
+        order = _order_shape(order_by, qualify)
+        if limit is not None:
+            params.append(int(limit))
+        if offset is not None:
+            params.append(int(offset))
+        def build():
+            source = table
+            for kind, name, on in join_shape:
+                source += ' %s JOIN %s ON %s' % (kind, name, 
+                        self._logical_operator(on, 0))
+            sql = "SELECT %s FROM %s %s" % (column, source, self._where(shape))
+            if order:
+                sql = '%s ORDER BY %s' % (sql.rstrip(), ','.join(
+                        '%s%s' % (name, ' DESC' if desc else '') 
+                        for name, desc in order))
+            if limit is not None:
+                sql = '%s LIMIT %%s' % sql.rstrip()
+            elif offset is not None and self._dialect in _no_limit:
+                # mysql and sqlite need LIMIT before OFFSET
+                sql = '%s LIMIT %s' % (sql.rstrip(), _no_limit[self._dialect])
+            if offset is not None:
+                sql = '%s OFFSET %%s' % sql.rstrip()
+            return sql
+        return self._statement(('select', table, column, join_shape, shape, 
+                order, limit is not None, offset is not None), build, params)
+
+    def select(self, obj, *where, **options):
         """SQL select.
 
+        >>> sql.select(User.name, User.age > 30, order_by = User.age.desc(),
+        ...         limit = 10, offset = 20)
+        ... SELECT name FROM User WHERE ((age>30)) ORDER BY age DESC LIMIT 10
+        ... OFFSET 20
+        ...
+        >>> sql.select([User.name, Order.total.label('total'), Order], 
+        ...         User.age > 30, 
+        ...         join = LeftJoin(Order, User.id == Order.user_id))
+        ... SELECT User.name,Order.total AS total,Order.* FROM User LEFT JOIN
+        ... Order ON ((User.id=Order.user_id)) WHERE ((User.age>30))
+
         Args:
-            obj: the 
+            obj: the Table or Column object, or a list of them (sql strings
+                like 'COUNT(*) AS n' can be in the list too). The table of
+                the first one is the FROM table.
             *where: condition
+            join: InnerJoin/LeftJoin or a list of them, columns are selected
+                and compared as table.name when there are joins.
+            order_by: Column (ascending), column.desc(), column.asc() or a 
+                list of them.
+            limit: max number of rows.
+            offset: number of rows to skip. (NOTE: the database still reads
+                the skipped rows, use paginate() for deep pages.)
+            cache: False to skip the result cache (True).
         """
-        table, column = obj._path_arr
-        if not column:
-            column = "*"
-        where = self._where(where)
-        sql = "SELECT %s FROM %s %s" % (column, table, where)
-        return self._db.get(sql)
+        cache = options.pop('cache', True)
+        sql, params = self.select_sql(obj, *where, **options)
+        key = None
+        if cache and self._results is not None:
+            key = _params_key(params)
+        if key is None:
+            return self._execute('get', sql, params)
+        key = (sql, key)
+        rows = self._results.get(key)
+        if rows is not None:
+            return list(rows)
+        if self._in_transaction():
+            # it may see uncommitted rows, which can't be shared
+            return self._execute('get', sql, params)
+        joins = _as_joins(options.get('join'))
+        tables = [_projection(obj, True)[0]] + [j._table for j in joins]
+        versions = self._results.versions(tables)
+        rows = self._execute('get', sql, params)
+        self._results.put(key, versions, tuple(rows))
+        return rows
+
+    def _in_transaction(self):
+        """Returns True if the db is in a transaction of the caller."""
+        return bool(getattr(self._db, 'in_transaction', None) and 
+                self._db.in_transaction())
+
+    def invalidate(self, table = None):
+        """Invalidates the cached select results of the table (Table or 
+        name), or all the results if table is None.
+        """
+        if self._results is None:
+            return
+        if isinstance(table, Table):
+            table = table._path_arr[0]
+        self._results.invalidate(table)
+        if self._in_transaction() and hasattr(self._db, 'on_transaction_end'):
+            # others may read and cache the old rows until it's committed
+            self._db.on_transaction_end(self._results.invalidate, table)
+
+    def paginate(self, obj, key, *where, **kwargs):
+        """Pages through the table by key (keyset pagination). Each page is
+        selected by WHERE $key > $last_key ORDER BY $key LIMIT $page_size, so
+        every page costs same no matter how deep it is, if the key is
+        indexed. The key should be unique, e.g. primary key.
+
+        >>> for last_id, rows in sql.paginate(User, User.id, User.age > 30,
+        ...         page_size = 500):
+        ...     process(rows) # save last_id to continue later by start=
+
+        Args:
+            obj: the Table or Column object to select.
+            key: the key Column.
+            *where: condition
+            page_size: max number of rows in a page (1000).
+            start: the page starts after this key, None from the beginning.
+            descending: True to page from the biggest key (key < $last_key).
+        Yields:
+            (the key of the last row, the list of rows)
+        """
+        page_size = kwargs.pop('page_size', 1000)
+        last = kwargs.pop('start', None)
+        descending = kwargs.pop('descending', False)
+        if kwargs:
+            raise TypeError("Unknown arguments: %s" % ','.join(kwargs))
+        table, column = _projection(obj)
+        key = key._name if isinstance(key, Column) else key
+        # the key is selected first, so it's known for the next page.
+        if column == '*':
+            column = '%s.*' % table
+        column = '%s,%s' % (key, column)
+        order = Order(key, descending)
+        while True:
+            cond = where
+            if last is not None:
+                if descending:
+                    cond = where + (Condition(key, '<', last),)
+                else:
+                    cond = where + (Condition(key, '>', last),)
+            sql, params = self._select_sql(table, column, cond, 
+                    order_by = order, limit = page_size)
+            rows = self._execute('get', sql, params)
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield last, [tuple(row[1:]) for row in rows]
+            if len(rows) < page_size:
+                return
+
+    def iter_select(self, obj, *where, **kwargs):
+        """SQL select which yields the rows one by one. Rows are fetched by
+        cursor.fetchmany(batch_size) so only one batch is in memory, use a 
+        server-side cursor (see PooledDB stream_cursor) to keep the whole
+        result on the server. It needs db.cursor_get(), otherwise all the 
+        rows are got by db.get() first.
+
+        >>> for row in sql.iter_select(User, User.age > 30, batch_size = 500,
+        ...         named = True):
+        ...     print row.name
+
+        Args:
+            obj: same as select().
+            *where: condition
+            order_by, limit, offset: same as select().
+            batch_size: number of rows in each fetch (1000).
+            named: True to yield namedtuple rows with column names.
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        named = kwargs.pop('named', False)
+        sql, params = self.select_sql(obj, *where, **kwargs)
+        if not hasattr(self._db, 'cursor_get'):
+            rows = self._execute('get', sql, params)
+            names = _column_names(obj)
+            if named and None in names:
+                raise SQLError("Column names of '*' are unknown, db needs "
+                        "cursor_get()")
+            for row in rows:
+                yield row_class(names)(*row) if named else row
+            return
+        cursor = self._call_db('cursor_get', sql, params)
+        try:
+            cls = None
+            if named:
+                cls = row_class([d[0] for d in cursor.description])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield cls(*row) if cls else row
+        finally:
+            cursor.close()
+
+    def insert_sql(self, table, isignored = False, **kwargs):
+        """Returns (sql, params) of insert(), see insert()."""
+        columns = tuple(sorted(kwargs))
+        params = [kwargs[c] for c in columns]
+        def build():
+            ignore = ' IGNORE' if isignored else ''
+            return "INSERT%s INTO %s (%s) VALUES (%s)" % (ignore, table._name,
+                    ','.join(columns), ','.join(['%s'] * len(columns)))
+        return self._statement(('insert', table._name, bool(isignored), 
+                columns), build, params)
     
     def insert(self, table, isignored = False, **kwargs):
         """SQL insert. Rules:
@@ -188,21 +1376,23 @@ class SQL(object):
             table: the Table object.
             **kwargs: the insert info in dictionary
         """
-        columns = ','.join(kwargs.keys())
-        values = []
-        for val in kwargs.values():
-            if type(val) == str:
-                val = "'%s'" % val
-            else:
-                val = str(val)
-            values.append(val)
-        values = ','.join(values)
-        if isignored:
-            ignore = ' IGNORE'
-        else:
-            ignore = ''
-        sql = "INSERT%s INTO %s (%s) VALUES (%s)" % (ignore, table._name, columns, values)
-        self._db.put(sql)
+        sql, params = self.insert_sql(table, isignored, **kwargs)
+        try:
+            self._execute('put', sql, params)
+        finally:
+            self.invalidate(table)
+
+    def update_sql(self, table, *where, **kwargs):
+        """Returns (sql, params) of update(), see update()."""
+        keys = tuple(sorted(kwargs))
+        params = [kwargs[k] for k in keys]
+        shape = self._where_shape((where,) if where else (), params)
+        def build():
+            sets = ','.join('%s=%%s' % k for k in keys)
+            return "UPDATE %s SET %s %s" % (table._name, sets, 
+                    self._where(shape))
+        return self._statement(('update', table._name, keys, shape), build,
+                params)
         
     def update(self, table, *where, **kwargs):
         """SQL update. Rules:
@@ -214,17 +1404,435 @@ class SQL(object):
             *where: condition
             **kwargs: the update info in dictionary
         """
-        where = self._where(where)
-        setting = []
-        for key in kwargs:
-            val = kwargs[key]
-            if type(val) == str:
-                val = "'%s'" % val
+        sql, params = self.update_sql(table, *where, **kwargs)
+        try:
+            self._execute('put', sql, params)
+        finally:
+            self.invalidate(table)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Runs the block in a transaction if the db has begin() and commit(),
+        rollback() is called if there is an exception. If the db is in a
+        transaction of the caller already (db.in_transaction()), the block
+        is a part of it.
+        """
+        if not hasattr(self._db, 'commit') or self._in_transaction():
+            yield
+            return
+        if hasattr(self._db, 'begin'):
+            self._db.begin()
+        try:
+            yield
+        except:
+            if hasattr(self._db, 'rollback'):
+                self._db.rollback()
+            raise
+        self._db.commit()
+
+    def insert_many_sql(self, table, columns, rows, isignored = False):
+        """Returns (sql, params) of a multi-row INSERT.
+
+        Args:
+            table: the Table object.
+            columns: tuple of column names.
+            rows: list of value tuples in the order of columns.
+            isignored: True to use INSERT IGNORE.
+        """
+        params = [val for row in rows for val in row]
+        def build():
+            ignore = ' IGNORE' if isignored else ''
+            values = '(%s)' % ','.join(['%s'] * len(columns))
+            return "INSERT%s INTO %s (%s) VALUES %s" % (ignore, table._name,
+                    ','.join(columns), ','.join([values] * len(rows)))
+        # multi-row statements aren't cached, the chunks can be of any size 
+        # and they would push the common statements out of the cache.
+        key = None
+        if len(rows) == 1:
+            key = ('insert_many', table._name, bool(isignored), columns)
+        return self._statement(key, build, params)
+
+    def insert_many(self, table, rows, chunk_size = 500, isignored = False,
+            max_statement_size = 1048576, executemany = None):
+        """SQL insert of many rows. Rows are sent in chunks, each chunk is one
+        multi-row INSERT (or one db.put_many() call) in one transaction, a 
+        chunk is also cut when its sql would be bigger than 
+        max_statement_size (e.g. max_allowed_packet of mysql).
+
+        >>> sql.insert_many(User, [{'name': 'A', 'age': 1}, 
+        ...                        {'name': 'B', 'age': 2}])
+
+        Args:
+            table: the Table object.
+            rows: iterable of dicts, all with same keys.
+            chunk_size: max number of rows in a chunk.
+            isignored: True to use INSERT IGNORE.
+            max_statement_size: max size of the sql (with values) in bytes.
+            executemany: True to use db.put_many(), False to use multi-row
+                INSERT, None to use db.put_many() if the db has it.
+        Returns:
+            the number of rows sent.
+        """
+        if executemany is None:
+            executemany = hasattr(self._db, 'put_many')
+        count = 0
+        for columns, chunk in _chunks(rows, chunk_size, max_statement_size):
+            self._insert_chunk(table, columns, chunk, isignored, executemany)
+            count += len(chunk)
+        return count
+
+    def _insert_chunk(self, table, columns, chunk, isignored, executemany):
+        """Sends one chunk of insert_many() in a transaction."""
+        try:
+            with self._transaction():
+                if executemany:
+                    sql = self.insert_many_sql(table, columns, chunk[:1], 
+                            isignored)[0]
+                    style = self._paramstyle
+                    self._call_db('put_many', sql, [_style_params(
+                            list(values), style) for values in chunk], 
+                            len(chunk) * len(columns))
+                else:
+                    sql, params = self.insert_many_sql(table, columns, chunk, 
+                            isignored)
+                    self._execute('put', sql, params)
+        finally:
+            # after commit, so results read before it are not kept
+            self.invalidate(table)
+
+    def upsert_many_sql(self, table, columns, rows, keys, update = None):
+        """Returns (sql, params) of a multi-row upsert, see upsert_many().
+
+        Args:
+            table: the Table object.
+            columns: tuple of column names.
+            rows: list of value tuples in the order of columns.
+            keys: tuple of the unique key columns.
+            update: tuple of columns to update, None for all the columns not
+                in keys.
+        """
+        if update is None:
+            update = tuple(c for c in columns if c not in keys)
+        params = [val for row in rows for val in row]
+        dialect = self._dialect
+        def build():
+            values = '(%s)' % ','.join(['%s'] * len(columns))
+            sql = "INSERT%s INTO %s (%s) VALUES %s" % (
+                    ' IGNORE' if dialect == 'mysql' and not update else '',
+                    table._name, ','.join(columns), 
+                    ','.join([values] * len(rows)))
+            if dialect == 'mysql':
+                if update:
+                    sql += ' ON DUPLICATE KEY UPDATE %s' % ','.join(
+                            '%s=VALUES(%s)' % (c, c) for c in update)
+            elif update:
+                sql += ' ON CONFLICT (%s) DO UPDATE SET %s' % (','.join(keys),
+                        ','.join('%s=excluded.%s' % (c, c) for c in update))
             else:
-                val = str(val)
-            single_set = '%s=%s' % (key, val)
-            setting.append(single_set)
-        sets = ','.join(setting)
-        sql = "UPDATE %s SET %s %s" % (table._name, sets, where)
-        self._db.put(sql)
+                sql += ' ON CONFLICT (%s) DO NOTHING' % ','.join(keys)
+            return sql
+        key = None # multi-row statements aren't cached, see insert_many_sql
+        if len(rows) == 1:
+            key = ('upsert_many', dialect, table._name, columns, tuple(keys),
+                    tuple(update))
+        return self._statement(key, build, params)
+
+    def upsert_many(self, table, rows, keys, update = None, chunk_size = 500,
+            max_statement_size = 1048576):
+        """Inserts the rows, or updates them if the unique keys exist 
+        (INSERT .. ON DUPLICATE KEY UPDATE of mysql, INSERT .. ON CONFLICT 
+        of postgresql and sqlite). Rows are sent in chunks like 
+        insert_many(), each chunk is one statement in one transaction.
+
+        >>> sql.upsert_many(User, [{'id': 1, 'name': 'A', 'age': 1}, 
+        ...                        {'id': 2, 'name': 'B', 'age': 2}], ['id'])
+
+        Args:
+            table: the Table object.
+            rows: iterable of dicts, all with same keys.
+            keys: the unique key columns (Column or name) which decide if 
+                the row exists (mysql uses all the unique keys of the table, 
+                they are only left out from the update then).
+            update: the columns to update if the row exists, None for all 
+                the columns not in keys, [] to leave the row as it is.
+            chunk_size: max number of rows in a chunk.
+            max_statement_size: max size of the sql (with values) in bytes.
+        Returns:
+            the number of rows sent.
+        """
+        keys = tuple(k._name if isinstance(k, Column) else k for k in keys)
+        if update is not None:
+            update = tuple(c._name if isinstance(c, Column) else c 
+                    for c in update)
+        if not keys and self._dialect != 'mysql':
+            raise SQLError("upsert of %s needs keys" % self._dialect)
+        count = 0
+        for columns, chunk in _chunks(rows, chunk_size, max_statement_size):
+            missing = [k for k in keys if k not in columns]
+            if missing:
+                raise SQLError("Rows don't have key %s" % ','.join(missing))
+            sql, params = self.upsert_many_sql(table, columns, chunk, keys,
+                    update)
+            try:
+                with self._transaction():
+                    self._execute('put', sql, params)
+            finally:
+                self.invalidate(table)
+            count += len(chunk)
+        return count
+
+    def delete_sql(self, table, *where):
+        """Returns (sql, params) of DELETE, see delete_where()."""
+        params = []
+        shape = self._where_shape((where,) if where else (), params)
+        def build():
+            return "DELETE FROM %s %s" % (table._name, self._where(shape))
+        return self._statement(('delete', table._name, shape), build, params)
+
+    def delete_where(self, table, *where, **kwargs):
+        """SQL delete. If key is given, the rows are deleted in batches by 
+        ranges of the key (primary key): the keys of next chunk_size rows 
+        are selected in key order, then the rows in the range are deleted in
+        a small transaction, so locks are held shortly and other writers 
+        (and replication) can go on between the batches.
+
+        >>> sql.delete_where(Log, Log.time < cutoff, key = Log.id, 
+        ...         chunk_size = 1000, pause = 0.1)
+        ... SELECT id,id FROM Log WHERE ((time<..)) ORDER BY id LIMIT 1000
+        ... DELETE FROM Log WHERE ((time<.. AND id>=1 AND id<=1000))
+        ... ...
+
+        Args:
+            table: the Table object.
+            *where: condition, all the rows are deleted if there is none.
+            key: the key Column (indexed and unique) to split the batches, 
+                None to delete by one statement.
+            chunk_size: number of rows in a batch (1000).
+            pause: seconds to sleep between batches (0).
+        Returns:
+            the number of rows deleted if key is given (rows deleted by 
+            others while it's running are counted too), otherwise None.
+        """
+        key = kwargs.pop('key', None)
+        chunk_size = kwargs.pop('chunk_size', 1000)
+        pause = kwargs.pop('pause', 0)
+        if kwargs:
+            raise TypeError("Unknown arguments: %s" % ','.join(kwargs))
+        if key is None:
+            sql, params = self.delete_sql(table, *where)
+            try:
+                with self._transaction():
+                    self._execute('put', sql, params)
+            finally:
+                self.invalidate(table)
+            return None
+        name = key._name if isinstance(key, Column) else key
+        column = Column(name, table._name)
+        count = 0
+        for last, rows in self.paginate(column, column, *where, 
+                page_size = chunk_size):
+            sql, params = self.delete_sql(table, *(where + (
+                    Condition(name, '>=', rows[0][0]), 
+                    Condition(name, '<=', last))))
+            try:
+                with self._transaction():
+                    self._execute('put', sql, params)
+            finally:
+                self.invalidate(table)
+            count += len(rows)
+            if pause and len(rows) == chunk_size:
+                time.sleep(pause)
+        return count
+
+    def buffered(self, **kwargs):
+        """Returns a WriteBuffer of this object, see WriteBuffer."""
+        return WriteBuffer(self, **kwargs)
+
+
+def _chunks(rows, chunk_size, max_statement_size):
+    """Yields (columns, [value tuple, ..]) of the row dicts in chunks, see
+    SQL.insert_many().
+    """
+    columns = None
+    chunk = []
+    chunk_bytes = 0
+    for row in rows:
+        if columns is None:
+            columns = tuple(sorted(row))
+        elif len(row) != len(columns):
+            raise SQLError("All rows must have same columns: %s" % 
+                    ','.join(columns))
+        try:
+            values = tuple(row[c] for c in columns)
+        except KeyError, e:
+            raise SQLError("Row doesn't have column %s" % e)
+        size = sum(len(_literal(v)) for v in values) + len(values) + 3
+        if chunk and (len(chunk) >= chunk_size or 
+                chunk_bytes + size > max_statement_size):
+            yield columns, chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(values)
+        chunk_bytes += size
+    if chunk:
+        yield columns, chunk
+
+
+class WriteBuffer(object):
+    """ WriteBuffer queues insert() and update() of a SQL object and sends
+    them later in one transaction, inserts of same table and columns are
+    sent as multi-row INSERTs. It's flushed when max_rows or max_bytes is
+    reached, by a timer max_delay seconds after the first queued write, by 
+    flush(), or at the end of with block.
+
+    >>> with sql.buffered(max_rows = 500, max_delay = 1.0) as buf:
+    ...     for event in events:
+    ...         buf.insert(Log, name = event.name, time = event.time)
+    ...         buf.update(User, User.id == event.user, last = event.time)
+
+    Updates are sent in the order they are queued. Inserted rows are sent 
+    together at the place of the first queued row of the table, unless an
+    update of the table is queued after it, so call flush() between writes 
+    that depend on each other across tables (e.g. foreign keys).
+
+    The timer of max_delay flushes in its own thread, so it isn't part of
+    the transaction of the thread which queued the writes, don't use 
+    max_delay for writes queued in a transaction.
+    """
+
+    def __init__(self, sql, max_rows = 1000, max_bytes = 1048576, 
+            max_delay = None, chunk_size = 500, on_error = None):
+        """Constructor.
+
+        Args:
+            sql: the SQL object.
+            max_rows: flushes when this many rows are queued.
+            max_bytes: flushes when the values are about this many bytes.
+            max_delay: seconds since the first queued write to flush, None
+                means no time limit.
+            chunk_size: max number of rows in a multi-row INSERT.
+            on_error: function called with the exception if the flush of 
+                the max_delay timer fails, the writes are kept in the queue
+                and the next write flushes them again.
+        """
+        self._sql = sql
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.chunk_size = chunk_size
+        self.on_error = on_error
+        self._lock = threading.RLock()
+        self._timer = None
+        self._reset()
+
+    def _reset(self):
+        # ops are ['insert', table, isignored, columns, rows] or 
+        # ['update', table, sql, params] in the queued order.
+        self._ops = []
+        self._groups = {} # (table name, isignored, columns): insert op
+        self._rows = 0
+        self._bytes = 0
+        self._since = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def __len__(self):
+        """The number of queued rows."""
+        return self._rows
+
+    def insert(self, table, isignored = False, **kwargs):
+        """Queues SQL insert, same as SQL.insert()."""
+        columns = tuple(sorted(kwargs))
+        values = tuple(kwargs[c] for c in columns)
+        key = (table._name, bool(isignored), columns)
+        with self._lock:
+            op = self._groups.get(key)
+            if op is None:
+                op = ['insert', table, isignored, columns, []]
+                self._groups[key] = op
+                self._ops.append(op)
+            op[4].append(values)
+            self._queued(values)
+
+    def update(self, table, *where, **kwargs):
+        """Queues SQL update, same as SQL.update()."""
+        sql, params = self._sql.update_sql(table, *where, **kwargs)
+        with self._lock:
+            # later inserts of the table can't be moved before the update
+            for key in [k for k in self._groups if k[0] == table._name]:
+                del self._groups[key]
+            self._ops.append(['update', table, sql, params])
+            self._queued(params.values() if isinstance(params, dict) 
+                    else params)
+
+    def _queued(self, values):
+        """Counts the queued row and flushes if a limit is reached."""
+        self._rows += 1
+        self._bytes += sum(len(_literal(v)) for v in values) + len(values)
+        now = time.time()
+        if self._since is None:
+            self._since = now
+            if self.max_delay is not None:
+                self._timer = threading.Timer(self.max_delay, self._timeout)
+                self._timer.daemon = True
+                self._timer.start()
+        if self._rows >= self.max_rows or self._bytes >= self.max_bytes or \
+                (self.max_delay is not None and 
+                 now - self._since >= self.max_delay):
+            self.flush()
+
+    def _timeout(self):
+        """Flushes by the max_delay timer."""
+        with self._lock:
+            if self._timer is None or \
+                    threading.current_thread() is not self._timer:
+                return # flushed or discarded meanwhile
+            self._timer = None
+            try:
+                self.flush()
+            except Exception, e:
+                if self.on_error is not None:
+                    self.on_error(e)
+
+    def flush(self):
+        """Sends the queued writes in one transaction. If it fails, the 
+        transaction is rolled back and the writes are kept in the queue, 
+        call flush() again or discard() them.
+
+        Returns:
+            the number of rows sent.
+        """
+        with self._lock:
+            if not self._ops:
+                return 0
+            sql = self._sql
+            ops, count = self._ops, self._rows
+            try:
+                with sql._transaction():
+                    for op in ops:
+                        if op[0] == 'update':
+                            sql._execute('put', op[2], op[3])
+                            continue
+                        _, table, isignored, columns, rows = op
+                        for i in xrange(0, len(rows), self.chunk_size):
+                            stmt, params = sql.insert_many_sql(table, columns,
+                                    rows[i:i + self.chunk_size], isignored)
+                            sql._execute('put', stmt, params)
+            finally:
+                for name in set(op[1]._name for op in ops):
+                    sql.invalidate(name)
+            self._reset()
+            return count
+
+    def discard(self):
+        """Drops the queued writes without sending them."""
+        with self._lock:
+            self._reset()
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
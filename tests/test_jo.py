@@ -0,0 +1,201 @@
+""" Tests of pl.jo. """
+import copy
+import json
+import os
+import pickle
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from pl.jo import FrozenJsonObject, JsonObject, JoError, JoStore
+
+
+class IterLoadTest(unittest.TestCase):
+
+    docs = [
+        '[1.5e3, -0.25, 10, 1E-2, -7, 0, 2.0E+10]',
+        '["a", "", "b\\"c", "d\\\\", "\\u00e9\\n", "x,]}"]',
+        '[true, false, null, [], {}, [true]]',
+        ' [ {"a": 1.5, "b": [1, 2.25e1]} , {"a": "s\\"}", "c": null} ] ',
+        '[{"p": "pad"}, 1.5e3, {"q": [1.25, {"r": -3e-1}]}, 12345]',
+    ]
+
+    def load(self, doc, chunk_size, path = '*'):
+        fp = StringIO.StringIO(doc)
+        return [jo.to_dict() if isinstance(jo, JsonObject) else jo
+                for jo in JsonObject.iter_load(fp, path, chunk_size)]
+
+    def test_chunk_sizes(self):
+        for doc in self.docs:
+            expected = json.loads(doc)
+            for chunk_size in xrange(1, 9):
+                self.assertEqual(self.load(doc, chunk_size), expected,
+                        '%r at chunk size %d' % (doc, chunk_size))
+
+    def test_float_on_chunk_boundary(self):
+        # the chunk ends right after '1' and right after '1.5e'
+        for pad in ('x' * 8, 'x' * 10):
+            doc = '[{"p": "%s"}, 1.5e3]' % pad
+            for chunk_size in (len(doc) - 6, len(doc) - 4):
+                self.assertEqual(self.load(doc, chunk_size)[1], 1500.0)
+
+    def test_path(self):
+        doc = '{"items": [{"id": 1.5}, {"id": "a"}], "skip": [1, {"x": "]"}]}'
+        for chunk_size in xrange(1, 9):
+            self.assertEqual(self.load(doc, chunk_size, 'items.*.id'),
+                    [1.5, 'a'])
+            self.assertEqual(self.load(doc, chunk_size, 'items.1'),
+                    [{'id': 'a'}])
+
+    def test_invalid(self):
+        for doc in ('[1, 2', '[1 2]', '[1.5.5]', '["a]'):
+            for chunk_size in (1, 3, 64):
+                self.assertRaises(JoError, self.load, doc, chunk_size)
+
+
+class DeepMergeTest(unittest.TestCase):
+
+    def overlay(self):
+        return {'a': {'c': {'x': 1}}, 'e': {'f': {'g': 1}}, 'l': [{'h': 1}]}
+
+    def test_overlay_not_changed(self):
+        for base in (JsonObject({'a': {'b': 1}, 'l': [1]}),
+                FrozenJsonObject({'a': {'b': 1}, 'l': [1]})):
+            overlay = self.overlay()
+            merged = base.deep_merge(overlay)
+            self.assertEqual(overlay, self.overlay())
+            self.assertEqual(type(overlay['e']['f']), dict)
+            self.assertEqual(type(overlay['l'][0]), dict)
+            self.assertEqual((merged.a.b, merged.a.c.x, merged.e.f.g,
+                    merged.l[0].h), (1, 1, 1, 1))
+            if not isinstance(merged, FrozenJsonObject):
+                merged.e.f.g = 2
+                merged.l[0].h = 2
+                self.assertEqual(overlay, self.overlay())
+
+
+class JoListTest(unittest.TestCase):
+
+    def test_reversed(self):
+        raw = [{'a': 1}, [{'b': 2}], 3]
+        jo = JsonObject({'l': raw})
+        items = list(reversed(jo.l))
+        self.assertEqual(items[0], 3)
+        self.assertEqual(items[1][0].b, 2)
+        self.assertEqual(items[2].a, 1)
+        self.assertTrue(items[2] is jo.l[0]) # wrapped once
+        self.assertEqual(list(reversed(jo.l)), list(jo.l)[::-1])
+        self.assertEqual(raw, [{'a': 1}, [{'b': 2}], 3])
+        self.assertTrue(jo.l[0].__dict__ is raw[0]) # the dict is shared
+
+
+class FrozenJsonObjectTest(unittest.TestCase):
+
+    def test_pickle_and_copy_after_hash(self):
+        jo = FrozenJsonObject({'a': {'b': [1, 2]}, 't': True})
+        h = hash(jo)
+        copies = [pickle.loads(pickle.dumps(jo, protocol))
+                for protocol in (0, 1, 2)]
+        copies += [copy.copy(jo), copy.deepcopy(jo)]
+        for other in copies:
+            self.assertTrue(isinstance(other, FrozenJsonObject))
+            self.assertEqual(other, jo)
+            self.assertEqual(hash(other), h)
+            self.assertEqual(other.a.b, (1, 2))
+
+
+class PatchTest(unittest.TestCase):
+
+    pairs = [
+        ({'a': 1, 'b': {'c': [1, 2, 3]}}, {'a': 2, 'b': {'c': [1, 4]}}),
+        ({'a': [1, {'x': 1}]}, {'a': [1, {'x': 2, 'y': None}, 'z']}),
+        ({'a': 1, 't': True}, {'a': True, 't': 1, 'n': {'m': []}}),
+        ({'k/~': {'d': 1}}, {'k/~': {}, 'e': 'f'}),
+        ({}, {'a': {'b': {'c': 1.5}}}),
+    ]
+
+    def test_diff_apply_round_trip(self):
+        for a, b in self.pairs:
+            for src, dst in ((a, b), (b, a)):
+                jo = JsonObject(json.loads(json.dumps(src)))
+                patch = jo.diff(dst)
+                jo.apply(json.dumps(patch))
+                # json, so true and 1 are different
+                self.assertEqual(json.dumps(jo.to_dict(), sort_keys = True),
+                        json.dumps(dst, sort_keys = True))
+                self.assertEqual(jo.diff(dst), [])
+
+    def test_failed_move_keeps_value(self):
+        jo = JsonObject({'a': {'b': 1}, 'l': [1, 2]})
+        for path in ('/nope/x', '/l/9', '/l/x'):
+            self.assertRaises(JoError, jo.apply,
+                    [{'op': 'move', 'from': '/a', 'path': path}])
+            self.assertRaises(JoError, jo.apply,
+                    [{'op': 'move', 'from': '/l/0', 'path': path}])
+            self.assertEqual(jo.to_dict(), {'a': {'b': 1}, 'l': [1, 2]})
+        jo.apply([{'op': 'move', 'from': '/l/0', 'path': '/a/c'}])
+        self.assertEqual(jo.to_dict(), {'a': {'b': 1, 'c': 1}, 'l': [2]})
+
+    def test_test_op_types(self):
+        jo = JsonObject({'t': True, 'n': 1, 'l': [1, False]})
+        jo.apply([{'op': 'test', 'path': '/t', 'value': True},
+                {'op': 'test', 'path': '/n', 'value': 1.0},
+                {'op': 'test', 'path': '/l', 'value': [1, False]}])
+        for path, val in (('/t', 1), ('/n', True), ('/l', [True, 0])):
+            self.assertRaises(JoError, jo.apply,
+                    [{'op': 'test', 'path': path, 'value': val}])
+
+
+class LoadCachedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, doc):
+        with open(self.source, 'wb') as f:
+            f.write(doc)
+
+    def test_source_changed_while_parsing(self):
+        test = self
+        class Jo(JsonObject):
+            def __init__(self, *args, **kwargs):
+                JsonObject.__init__(self, *args, **kwargs)
+                test.write('{"a": 2, "b": 2}')
+        self.write('{"a": 1}')
+        self.assertEqual(Jo.load_cached(self.source).to_dict(), {'a': 1})
+        self.assertEqual(JsonObject.load_cached(self.source).to_dict(),
+                {'a': 2, 'b': 2})
+        self.assertEqual(JsonObject.load_cached(self.source).to_dict(),
+                {'a': 2, 'b': 2})
+
+
+class JoStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source.json')
+        self.path = os.path.join(self.tmp, 'data.store')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_build_float_on_chunk_boundary(self):
+        doc = '{"pad": "xxxxxxxxxx", "f": 1.5e3, "o": {"a": [2.25, "s"]}}'
+        with open(self.source, 'wb') as f:
+            f.write(doc)
+        cut = doc.index('1.5e3')
+        for chunk_size in (cut + 1, cut + 2, cut + 4, 1, 3, 7):
+            JoStore.build(self.source, self.path, chunk_size)
+            with JoStore(self.path) as store:
+                self.assertEqual(store['f'], 1500.0)
+                self.assertEqual(store.o.a, [2.25, 's'])
+                self.assertEqual(sorted(store.ls()), ['f', 'o', 'pad'])
+
+
+if __name__ == '__main__':
+    unittest.main()
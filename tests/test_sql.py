@@ -0,0 +1,332 @@
+""" Tests of pl.sql, sqlite3 is used as the database. """
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from pl.sql import InnerJoin, LeftJoin, PooledDB, QueryStats, SQL, \
+        SQLError, Table
+
+User = Table('User')
+Orders = Table('Orders')
+
+
+class PooledDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'test.db')
+        self.db = self.pool()
+        self.db.put('CREATE TABLE User (id INTEGER PRIMARY KEY, name TEXT)')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def pool(self, **kwargs):
+        kwargs.setdefault('timeout', 1)
+        return PooledDB(sqlite3, self.path, check_same_thread = False,
+                **kwargs)
+
+    def test_checkout_return(self):
+        self.assertEqual(self.db._size, 1)
+        with self.db.connection() as conn:
+            self.assertEqual(self.db._idle, [])
+        self.assertEqual([c for c, _ in self.db._idle], [conn])
+        self.db.put('INSERT INTO User (name) VALUES (?)', ('A',))
+        self.assertEqual(self.db.get('SELECT name FROM User'), [('A',)])
+        self.assertEqual(self.db._size, 1)
+        self.assertEqual(len(self.db._idle), 1)
+
+    def test_error_returns_connection(self):
+        self.assertRaises(sqlite3.OperationalError, self.db.get,
+                'SELECT * FROM Nope')
+        self.assertEqual(len(self.db._idle), 1)
+        self.assertEqual(self.db.get('SELECT COUNT(*) FROM User'), [(0,)])
+
+    def test_concurrency(self):
+        db = self.pool(max_size = 4)
+        errors = []
+        def work(n):
+            try:
+                for i in xrange(20):
+                    db.put('INSERT INTO User (name) VALUES (?)',
+                            ('%d-%d' % (n, i),))
+                    db.get('SELECT COUNT(*) FROM User')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = work, args = (n,))
+                for n in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(db.get('SELECT COUNT(*) FROM User'), [(160,)])
+        self.assertTrue(db._size <= 4)
+        self.assertEqual(len(db._idle), db._size)
+        db.close()
+
+    def test_transaction(self):
+        with self.db.transaction():
+            self.assertTrue(self.db.in_transaction())
+            self.db.put('INSERT INTO User (name) VALUES (?)', ('A',))
+        self.assertFalse(self.db.in_transaction())
+        try:
+            with self.db.transaction():
+                self.db.put('INSERT INTO User (name) VALUES (?)', ('B',))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.db.get('SELECT name FROM User'), [('A',)])
+        self.assertEqual(len(self.db._idle), 1)
+        self.db.begin()
+        self.assertRaises(SQLError, self.db.begin)
+        self.db.rollback()
+        self.assertRaises(SQLError, self.db.commit)
+
+    def test_health_check_discards_broken(self):
+        db = self.pool(health_check_interval = 0)
+        broken = db._idle[0][0]
+        broken.close()
+        self.assertEqual(db.get('SELECT COUNT(*) FROM User'), [(0,)])
+        self.assertEqual(db._size, 1)
+        self.assertTrue(broken not in [c for c, _ in db._idle])
+        db.close()
+
+    def test_commit_failure_returns_connection(self):
+        db = self.pool(max_size = 1)
+        db.put('PRAGMA foreign_keys = ON')
+        db.put('CREATE TABLE Orders (id INTEGER PRIMARY KEY, user_id '
+                'REFERENCES User(id) DEFERRABLE INITIALLY DEFERRED)')
+        db.begin()
+        db.put('INSERT INTO Orders (user_id) VALUES (?)', (42,))
+        self.assertRaises(sqlite3.IntegrityError, db.commit)
+        self.assertFalse(db.in_transaction())
+        self.assertEqual(db._size, 1)
+        self.assertEqual(db.get('SELECT COUNT(*) FROM Orders'), [(0,)])
+        db.close()
+
+    def test_cursor_close(self):
+        class BrokenCursor(object):
+            def close(self):
+                raise sqlite3.OperationalError('broken')
+        self.db.put('INSERT INTO User (name) VALUES (?)', ('A',))
+        cursor = self.db.cursor_get('SELECT name FROM User')
+        self.assertEqual(self.db._idle, [])
+        self.assertEqual(cursor.fetchmany(10), [('A',)])
+        cursor.close()
+        cursor.close()
+        self.assertEqual(len(self.db._idle), 1)
+        cursor = self.db.cursor_get('SELECT name FROM User')
+        cursor._cursor.close()
+        cursor._cursor = BrokenCursor()
+        self.assertRaises(sqlite3.OperationalError, cursor.close)
+        self.assertEqual((self.db._size, len(self.db._idle)), (1, 1))
+        self.assertEqual(self.db.get('SELECT COUNT(*) FROM User'), [(1,)])
+
+    def test_cursor_close_skips_health_check(self):
+        # the health check only runs for a connection returned after errors
+        db = self.pool(health_check = 'SELECT * FROM Nope')
+        conn = db._idle[0][0]
+        db.cursor_get('SELECT name FROM User').close()
+        self.assertEqual([c for c, _ in db._idle], [conn])
+        db.close()
+
+    def test_sql(self):
+        sql = SQL(self.db)
+        sql.insert(User, name = 'A')
+        self.assertEqual(sql.select(User.name, User.name == 'A'), [('A',)])
+
+    def test_sql_in_caller_transaction(self):
+        sql = SQL(self.db)
+        try:
+            with self.db.transaction():
+                sql.insert_many(User, [{'name': 'A'}, {'name': 'B'}])
+                sql.upsert_many(User, [{'id': 1, 'name': 'C'}], ['id'])
+                self.assertTrue(self.db.in_transaction())
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(sql.select(User), [])
+        with self.db.transaction():
+            sql.insert_many(User, [{'name': 'A'}, {'name': 'B'}])
+        self.assertEqual(sql.select(User.name), [('A',), ('B',)])
+
+    def test_result_cache_transaction(self):
+        sql = SQL(self.db, result_cache_size = 10)
+        try:
+            with self.db.transaction():
+                sql.insert(User, name = 'ghost')
+                self.assertEqual(sql.select(User.name), [('ghost',)])
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(sql.select(User.name), [])
+        # read by another thread before the commit
+        self.db.close()
+        self.db = self.pool(max_size = 2)
+        sql = SQL(self.db, result_cache_size = 10)
+        self.db.begin()
+        sql.insert(User, name = 'A')
+        t = threading.Thread(target = sql.select, args = (User.name,))
+        t.start()
+        t.join()
+        self.db.commit()
+        self.assertEqual(sql.select(User.name), [('A',)])
+
+    def test_query_stats_explain(self):
+        sql = SQL(self.db)
+        stats = QueryStats(sql, slow = 0, explain = True)
+        sql.select(User.name, User.id == 3)
+        event = stats.slow_log[-1]
+        self.assertEqual((event.method, event.param_count, event.rows), 
+                ('get', 1, 0))
+        plan = stats.explains[event.sql]
+        self.assertTrue(isinstance(plan, list) and plan)
+
+
+
+class SQLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = PooledDB(sqlite3, os.path.join(self.tmp, 'test.db'),
+                check_same_thread = False, timeout = 1)
+        self.db.put('CREATE TABLE User (id INTEGER PRIMARY KEY, name TEXT)')
+        self.sql = SQL(self.db)
+        self.sql.insert_many(User, [{'name': 'A'}, {'name': 'B%'}])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def test_percent_in_column_sql(self):
+        self.assertEqual(self.sql.select(["name LIKE '%\\%' ESCAPE '\\'",
+                User.id], order_by = User.id), [(0, 1), (1, 2)])
+        self.assertEqual(self.sql.select(["'100%s%%'", User.id], 
+                User.id == 1), [('100%s%%', 1)])
+
+
+    def test_iter_select(self):
+        self.sql.insert_many(User, [{'name': str(i)} for i in xrange(5)])
+        rows = list(self.sql.iter_select(User, User.id > 2, batch_size = 2,
+                order_by = User.id, named = True))
+        self.assertEqual([(r.id, r.name) for r in rows], 
+                [(3, '0'), (4, '1'), (5, '2'), (6, '3'), (7, '4')])
+        self.assertEqual(len(self.db._idle), 1)
+        # the connection is returned if the loop is left early
+        for row in self.sql.iter_select(User.name, batch_size = 2):
+            break
+        self.assertEqual(len(self.db._idle), 1)
+
+    def test_paginate(self):
+        self.sql.insert_many(User, [{'name': str(i)} for i in xrange(5)])
+        pages = list(self.sql.paginate(User.name, User.id, User.id > 1,
+                page_size = 2))
+        self.assertEqual([[name for name, in rows] for last, rows in pages],
+                [['B%', '0'], ['1', '2'], ['3', '4']])
+        self.assertEqual([last for last, rows in pages], [3, 5, 7])
+        pages = list(self.sql.paginate(User.id, User.id, start = 3, 
+                page_size = 2, descending = True))
+        self.assertEqual([rows for last, rows in pages], [[(2,), (1,)]])
+        # limit and offset of a page aren't mixed with the caller's options
+        self.assertRaises(TypeError, list, self.sql.paginate(User, User.id,
+                limit = 1))
+
+    def test_join(self):
+        self.db.put('CREATE TABLE Orders (id INTEGER PRIMARY KEY, '
+                'user_id INTEGER, total INTEGER)')
+        self.sql.insert_many(Orders, [{'user_id': 1, 'total': 5},
+                {'user_id': 1, 'total': 7}])
+        self.assertEqual(self.sql.select([User.name, Orders.total], 
+                join = InnerJoin(Orders, User.id == Orders.user_id), 
+                order_by = Orders.total), [('A', 5), ('A', 7)])
+        self.assertEqual(self.sql.select([User.name, 'COUNT(Orders.id)'],
+                Orders.total > 5,
+                join = LeftJoin(Orders, User.id == Orders.user_id),
+                order_by = User.id), [('A', 1)])
+        self.assertEqual(self.sql.select([User.name, Orders.total],
+                join = LeftJoin(Orders, User.id == Orders.user_id, 
+                Orders.total > 6), order_by = User.id),
+                [('A', 7), ('B%', None)])
+
+    def test_upsert_many(self):
+        self.sql.upsert_many(User, [{'id': 2, 'name': 'B'}, 
+                {'id': 3, 'name': 'C'}], ['id'])
+        self.sql.upsert_many(User, [{'id': 1, 'name': 'X'}, 
+                {'id': 4, 'name': 'D'}], [User.id], update = [])
+        self.assertEqual(self.names(), ['A', 'B', 'C', 'D'])
+
+    def test_delete_where(self):
+        self.sql.insert_many(User, [{'name': str(i)} for i in xrange(10)])
+        self.assertEqual(self.sql.delete_where(User, User.id > 4, 
+                key = User.id, chunk_size = 3), 8)
+        self.assertEqual(self.names(), ['A', 'B%', '0', '1'])
+        self.assertEqual(self.sql.delete_where(User, User.id == 3), None)
+        self.assertEqual(self.names(), ['A', 'B%', '1'])
+        self.sql.delete_where(User)
+        self.assertEqual(self.names(), [])
+
+    def names(self):
+        return [name for name, in self.sql.select(User.name, 
+                order_by = User.id)]
+
+    def test_write_buffer_coalesces_inserts(self):
+        events = []
+        self.sql.add_hook(events.append)
+        with self.sql.buffered() as buf:
+            for i in xrange(5):
+                buf.insert(User, name = str(i))
+            self.assertEqual(len(buf), 5)
+            self.assertEqual(events, [])
+        inserts = [e for e in events if e.sql.startswith('INSERT')]
+        self.assertEqual([e.param_count for e in inserts], [5])
+        self.assertEqual(self.names(), ['A', 'B%', '0', '1', '2', '3', '4'])
+
+    def test_write_buffer_order_around_update(self):
+        with self.sql.buffered() as buf:
+            buf.insert(User, name = 'C')
+            buf.update(User, User.name == 'C', name = 'D')
+            buf.insert(User, name = 'C')
+        self.assertEqual(self.names(), ['A', 'B%', 'D', 'C'])
+
+    def test_write_buffer_retry_after_failed_flush(self):
+        Log = Table('Log')
+        buf = self.sql.buffered()
+        buf.insert(User, name = 'C')
+        buf.insert(Log, msg = 'x')
+        self.assertRaises(sqlite3.OperationalError, buf.flush)
+        self.assertEqual(len(buf), 2)
+        self.assertEqual(self.names(), ['A', 'B%'])
+        self.db.put('CREATE TABLE Log (msg TEXT)')
+        self.assertEqual(buf.flush(), 2)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(self.names(), ['A', 'B%', 'C'])
+        self.assertEqual(self.sql.select(Log.msg), [('x',)])
+
+    def wait(self, cond):
+        for i in xrange(200):
+            if cond():
+                break
+            time.sleep(0.01)
+
+    def test_write_buffer_max_delay(self):
+        buf = self.sql.buffered(max_delay = 0.05)
+        buf.insert(User, name = 'C')
+        self.wait(lambda: not len(buf))
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(self.names(), ['A', 'B%', 'C'])
+        errors = []
+        buf = self.sql.buffered(max_delay = 0.05, on_error = errors.append)
+        buf.insert(Table('Log'), msg = 'x')
+        self.wait(lambda: errors)
+        self.assertTrue(isinstance(errors[0], sqlite3.OperationalError))
+        self.assertEqual(len(buf), 1)
+        buf.discard()
+
+if __name__ == '__main__':
+    unittest.main()